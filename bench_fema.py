@@ -0,0 +1,304 @@
+import os
+import io
+import re
+import sys
+import json
+import hashlib
+import time
+import random
+import argparse
+import tempfile
+import shutil
+import multiprocessing
+from contextlib import redirect_stdout
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+# ingest benchmarks against a local stand-in for the openFEMA api, nothing here touches fema.gov.
+# every case runs build_query -> fetch -> save -> parse for one dataset in a fresh process (so peak rss means something)
+# against a mock OData server in another process. the http cache is off, so fetch is the wire plus decoding. fetch and
+# save are one streaming pass, as in the app: fetch is the time spent waiting on the next page, save the rest, and peak
+# rss is what the streaming ingest (then the chunked parse) really holds.
+#   python bench_fema.py                                      1k / 100k / 1M records for every dataset
+#   python bench_fema.py --sizes 1000,100000 --latency 0.05 --error-rate 0.02
+#   python bench_fema.py --save-baseline bench_baseline.json
+#   python bench_fema.py --baseline bench_baseline.json       exits 1 when fetch, save or parse got slower, or peak rss
+#                                                             grew, against the baseline
+BENCH_SIZES = [1000, 100000, 1000000]
+BENCH_TOLERANCE = 0.25
+# rss growth below this is noise (allocator, import order) rather than a regression
+BENCH_RSS_SLACK_MB = 16
+
+# mock openFEMA
+# records are made up from their index, so the server holds nothing and any $skip window costs the same
+BENCH_STATES = {"CA": "California"}
+INCIDENT_TYPES = ["Fire", "Flood", "Severe Storm", "Earthquake", "Hurricane"]
+PROGRAM_AREAS = ["HMGP", "BRIC", "FMA", "PDM"]
+
+def fake_record(entity, i):
+    rnd = random.Random(i)
+    record = {
+        "id": f"{entity[:4].lower()}-{i:08d}",
+        "lastRefresh": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:00.000Z",
+        "stateCode": "CA",
+        "state": "California",
+        "disasterNumber": 4000 + i % 400,
+    }
+    if entity == "PublicAssistanceApplicantsProgramDeliveries":
+        record.update({
+            "declarationType": "DR",
+            "incidentType": INCIDENT_TYPES[i % len(INCIDENT_TYPES)],
+            "applicantName": f"City of Example {i % 5000}",
+            "federalShareObligated": round(rnd.uniform(-1000, 2000000), 2),
+        })
+    elif entity == "HazardMitigationAssistanceProjects":
+        record.update({
+            "programArea": PROGRAM_AREAS[i % len(PROGRAM_AREAS)],
+            "programFy": 2010 + i % 14,
+            "recipient": f"Example Recipient {i % 3000}",
+            "federalShareObligated": round(rnd.uniform(0, 5000000), 2),
+        })
+    else:
+        record.update({
+            "legalAgencyName": f"Example Agency {i % 800}",
+            "projectEndDate": f"20{10 + i % 14}-09-30T00:00:00.000Z",
+            "fundingAmount": round(rnd.uniform(10000, 900000), 2),
+        })
+    return record
+
+class MockFemaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload=None, headers=None, body=None):
+        if body is None:
+            body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        config = self.server.config
+        if config["latency"]:
+            time.sleep(config["latency"])
+        parts = urlsplit(self.path)
+        entity = parts.path.rsplit("/", 1)[-1]
+        if entity not in config["entities"]:
+            return self.send_json(404, {"error": f"unknown entity {entity}"})
+        params = dict(parse_qsl(parts.query))
+        config["requests"].append(params)
+        top, skip = int(params.get("$top", 1000)), int(params.get("$skip", 0))
+        if skip in config["fail_skips"] or random.random() < config["error_rate"]:
+            return self.send_json(random.choice([429, 500, 502, 503]), headers={"Retry-After": "0"})
+        if config["rows"] is None:
+            # every synthetic record is in the one bench state; a delta query (lastRefresh gt ...) just finds nothing new
+            total = 0 if "lastRefresh gt" in params.get("$filter", "") else config["size"]
+            records = [fake_record(entity, i) for i in range(skip, min(skip + top, total))]
+        else:
+            rows = matching_rows(config["rows"], params)
+            total, records = len(rows), rows[skip:skip + top]
+        select = params["$select"].split(",") if "$select" in params else None
+        payload = {entity: [{field: record.get(field) for field in select} if select else record for record in records]}
+        if "$count" in params or "$inlinecount" in params:
+            payload["metadata"] = {"count": total}
+        # an ETag over the body, so a client can revalidate with If-None-Match and get a 304 when nothing changed
+        body = json.dumps(payload).encode()
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_json(304, headers={"ETag": etag})
+        self.send_json(200, headers={"ETag": etag}, body=body)
+
+def matching_rows(rows, params):
+    # explicit rows (the tests hand these in) understand the lastRefresh filters and $orderby the delta sync sends
+    match = re.search(r"lastRefresh (ge|gt) '([^']*)'", params.get("$filter", ""))
+    if match:
+        op, mark = match.groups()
+        rows = [row for row in rows if row["lastRefresh"] > mark or (op == "ge" and row["lastRefresh"] == mark)]
+    if "$orderby" in params:
+        rows = sorted(rows, key=lambda row: (row["lastRefresh"], row["id"]), reverse=params["$orderby"].endswith("desc"))
+    return list(rows)
+
+def mock_server(config):
+    # config: entities served, plus either size (synthetic records) or rows (a list served as is). fail_skips are the
+    # $skip windows that always fail, and every request's params are appended to requests
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockFemaHandler)
+    server.daemon_threads = True
+    server.config = {"size": 0, "rows": None, "latency": 0.0, "error_rate": 0.0, "fail_skips": set(), "requests": [], **config}
+    return server
+
+def serve_mock(config, port_queue):
+    server = mock_server(config)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_mock(entities, size, latency=0.0, error_rate=0.0):
+    ctx = multiprocessing.get_context("spawn")
+    port_queue = ctx.Queue()
+    config = {"entities": list(entities), "size": size, "latency": latency, "error_rate": error_rate}
+    process = ctx.Process(target=serve_mock, args=(config, port_queue), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{port_queue.get(timeout=30)}"
+
+# benchmark cases
+def peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on macs
+        return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 2 ** 20, 1)
+        except (ImportError, AttributeError):
+            return None
+
+def timed_records(pages, clock):
+    # yields the records page by page, adding the time spent waiting on each page to clock["fetch"]
+    pages = iter(pages)
+    while True:
+        start = time.perf_counter()
+        page = next(pages, None)
+        clock["fetch"] += time.perf_counter() - start
+        if page is None:
+            return
+        if clock["first"] is None:
+            clock["first"] = time.perf_counter() - clock["start"]
+        yield from page
+
+def run_case(name, env, verbose, result_queue):
+    # sales1 reads its config at import, so the environment has to be in place first
+    os.environ.update(env)
+    import sales1
+    spec = sales1.fema_datasets[name]
+    shard = sales1.dataset_shards(spec)[0]
+    entity = sales1.response_key(spec)
+    log = sys.stdout if verbose else io.StringIO()
+    result = {"dataset": name}
+    with redirect_stdout(log):
+        start = time.perf_counter()
+        api_endpoint = sales1.dataset_query_url(spec, [shard["state"]], shard["year"])
+        result["build_query_ms"] = round((time.perf_counter() - start) * 1000, 3)
+
+        # fetch + save: pages off the wire, decoded and streamed to the shard's json copy
+        os.makedirs(os.path.dirname(shard["json_path"]), exist_ok=True)
+        clock = {"start": time.perf_counter(), "first": None, "fetch": 0.0}
+        saved = sales1.fema_save_stream(timed_records(sales1.fema_iter_pages(api_endpoint, entity, max_records=None), clock), shard["json_path"])
+        elapsed = time.perf_counter() - clock["start"]
+        result["records"] = saved
+        result["first_record_s"] = round(clock["first"] or elapsed, 4)
+        result["fetch_rps"] = round(saved / max(clock["fetch"], 1e-9), 1)
+        result["save_rps"] = round(saved / max(elapsed - clock["fetch"], 1e-9), 1)
+        result["ingest_rss_mb"] = peak_rss_mb()
+
+        # parse: saved json -> typed frame (-> parquet when pyarrow is there)
+        start = time.perf_counter()
+        if sales1.pa is not None:
+            sales1.save_columnar(spec, shard)
+        else:
+            sales1.typed_frame(spec, sales1.fema_iter_saved(shard["json_path"]))
+        result["parse_rps"] = round(saved / (time.perf_counter() - start), 1)
+    result["peak_rss_mb"] = peak_rss_mb()
+    result_queue.put(result)
+
+def bench(names, sizes, latency=0.0, error_rate=0.0, page_size=None, verbose=False):
+    from sales1 import fema_datasets
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for size in sizes:
+        server, base_url = start_mock([fema_datasets[name]["entity"] for name in names], size, latency, error_rate)
+        try:
+            for name in names:
+                workdir = tempfile.mkdtemp(prefix="bench_fema_")
+                env = {
+                    "FEMA_BASE_URL": base_url,
+                    "SALESDOCS_DIR": workdir,
+                    "FEMA_STATES": ",".join(BENCH_STATES),
+                    "FEMA_FISCAL_YEARS": "",
+                    "FEMA_HTTP_CACHE": "0",
+                }
+                if page_size:
+                    env["FEMA_PAGE_SIZE"] = str(page_size)
+                result_queue = ctx.Queue()
+                case = ctx.Process(target=run_case, args=(name, env, verbose, result_queue))
+                case.start()
+                try:
+                    result = result_queue.get()
+                finally:
+                    case.join()
+                    shutil.rmtree(workdir, ignore_errors=True)
+                result["size"] = size
+                results.append(result)
+                print(format_result(result))
+        finally:
+            server.terminate()
+    return results
+
+def format_result(result):
+    return (f"{result['dataset']:<13}{result['size']:>9,} records  "
+            f"build_query {result['build_query_ms']:.2f}ms  "
+            f"first record {result['first_record_s']:.3f}s  "
+            f"fetch {result['fetch_rps']:>10,.0f}/s  "
+            f"save {result['save_rps']:>10,.0f}/s  "
+            f"parse {result['parse_rps']:>10,.0f}/s  "
+            f"peak rss {result['ingest_rss_mb']}MB ingest, {result['peak_rss_mb']}MB overall")
+
+# regressions
+# fetch, save and parse throughput, time to first record and peak rss are compared case by case against a saved run
+def find_regressions(results, baseline, tolerance=BENCH_TOLERANCE):
+    previous = {(result["dataset"], result["size"]): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["dataset"], result["size"]))
+        if before is None:
+            continue
+        for metric in ("fetch_rps", "save_rps", "parse_rps"):
+            if metric in before and result[metric] < before[metric] * (1 - tolerance):
+                regressions.append(f"{result['dataset']} {result['size']:,}: {metric} {result[metric]:,.0f}/s, was {before[metric]:,.0f}/s")
+        if result["first_record_s"] > before["first_record_s"] * (1 + tolerance) + 0.05:
+            regressions.append(f"{result['dataset']} {result['size']:,}: first record {result['first_record_s']:.3f}s, was {before['first_record_s']:.3f}s")
+        for metric in ("ingest_rss_mb", "peak_rss_mb"):
+            if result[metric] and before.get(metric) and result[metric] > before[metric] * (1 + tolerance) + BENCH_RSS_SLACK_MB:
+                regressions.append(f"{result['dataset']} {result['size']:,}: {metric} {result[metric]}MB, was {before[metric]}MB")
+    return regressions
+
+def main():
+    from sales1 import fema_datasets
+    parser = argparse.ArgumentParser(description="Benchmark FEMA ingest against a local stand-in server.")
+    parser.add_argument("--datasets", default=",".join(fema_datasets), help="comma separated dataset names")
+    parser.add_argument("--sizes", default=",".join(map(str, BENCH_SIZES)), help="comma separated record counts")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the mock server waits before every response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of responses that come back 429/5xx")
+    parser.add_argument("--page-size", type=int, default=None, help="$top per request, defaults to FEMA_PAGE_SIZE")
+    parser.add_argument("--baseline", help="json from --save-baseline; exits 1 if throughput or peak rss regressed against it")
+    parser.add_argument("--save-baseline", help="write this run's results here")
+    parser.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE, help="allowed slowdown before it counts as a regression")
+    parser.add_argument("--verbose", action="store_true", help="show the ingest's own output")
+    args = parser.parse_args()
+
+    names = [name for name in args.datasets.split(",") if name]
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    results = bench(names, sizes, args.latency, args.error_rate, args.page_size, args.verbose)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"Saved baseline to '{args.save_baseline}'")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("No regressions.")
+
+if __name__ == "__main__":
+    main()
@@ -1,188 +1,898 @@
 import pandas as pd
+import numpy as np
 import os
+import re
+import time
+import random
+import argparse
 import requests
+import httpx
+import openai
+import instructor
+import asyncio
 import json
+import glob
+import operator
+import hashlib
+import sqlite3
+from contextlib import closing, contextmanager
+from functools import lru_cache
+import threading
+import queue
 import atexit
-from openai import OpenAI
+import contextvars
+import inspect
+import weakref
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
+from collections import deque
+from itertools import islice
+from array import array
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
+from urllib.parse import urlsplit, unquote
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+# orjson decodes pages and saved records a good deal faster when it's installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+# rapidfuzz links lead names that are spelled a little differently across datasets; without it only names that normalise
+# to the same key are linked
+try:
+    from rapidfuzz import fuzz, process as fuzz_process
+except ImportError:
+    fuzz = fuzz_process = None
+# cross-process file locks: flock everywhere but windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 from dotenv import load_dotenv
-from agency_swarm import set_openai_key, Agency, Agent
-from agency_swarm.tools import Retrieval, CodeInterpreter
+from agency_swarm import set_openai_key, set_openai_client, get_openai_client, Agency, Agent
+from agency_swarm.tools import Retrieval, BaseTool
 from agency_swarm.agents.browsing import BrowsingAgent
 from agency_swarm.agents.coding import CodingAgent
 
 # load keys here
+# nothing talks to openai at import time; check_keys runs from main() and init_openai on the first agent build.
+# init_openai also sets up the one openai client every agent and thread uses, on a keep-alive pool big enough for
+# OPENAI_MAX_CONNECTIONS requests at once, so concurrent sessions reuse warm connections instead of queueing for one
 load_dotenv()
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY not found in environment variables")
-data_gov_api_key = os.getenv("DATA_GOV_API_KEY")
-if not data_gov_api_key:
-    raise ValueError("DATA_GOV_API_KEY not found in environment variables")
-client = OpenAI(api_key=api_key) 
-set_openai_key(api_key)
-
-# data filtering and pulling and cleaning could use a ton of work im sure
-# New build_query function
-def cayg_build_query(base_url, version, entity, select=None, top=None, states=None, federal_share_not_zero=False):
-    query = f"{base_url}/{version}/{entity}"
-    params = []
-    if select:
-        select_query = ','.join(select)
-        params.append(f"$select={select_query}")
-    if top:
-        params.append(f"$top={top}")
-    filter_conditions = []
-    if states:
-        states_query = " or ".join([f"stateCode eq '{state}'" for state in states])
-        filter_conditions.append(f"({states_query})")
-    if federal_share_not_zero:
-        filter_conditions.append("(federalShareObligated gt 0 or federalShareObligated lt 0)")
-    if filter_conditions:
-        filter_query = " and ".join(filter_conditions)
-        params.append(f"$filter={filter_query}")
-    if params:
-        query += "?" + "&".join(params)
-    return query
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "64"))
+
+def check_keys():
+    if not os.getenv("OPENAI_API_KEY"):
+        raise ValueError("OPENAI_API_KEY not found in environment variables")
+    if not os.getenv("DATA_GOV_API_KEY"):
+        raise ValueError("DATA_GOV_API_KEY not found in environment variables")
+
+@lru_cache(maxsize=None)
+def init_openai():
+    check_keys()
+    set_openai_key(os.getenv("OPENAI_API_KEY"))
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+    # patched the same way agency_swarm patches its own default client
+    set_openai_client(instructor.patch(openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=5, http_client=http_client)))
+
+# shared openFEMA fetch engine
+# asks for the total count up front, then pulls the $skip windows concurrently over one pooled keep-alive session.
+# every host gets its own cap on in-flight requests so the three datasets can load side by side without hammering fema.gov.
+# transient failures (connection errors, 429, 5xx) are retried with jittered exponential backoff, and the per-host cap
+# backs off when the server throttles us and creeps back up while requests succeed
+# FEMA_BASE_URL / SALESDOCS_DIR / FEMA_PAGE_SIZE can be overridden from the environment (bench_fema.py points them at a stand-in).
+# FEMA_MAX_RECORDS is how many records the app keeps per shard, the most recently refreshed ones; 0 keeps everything
+FEMA_BASE_URL = os.getenv("FEMA_BASE_URL", "https://www.fema.gov/api/open")
+SALESDOCS_DIR = os.getenv("SALESDOCS_DIR", "c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs")
+FEMA_PAGE_SIZE = int(os.getenv("FEMA_PAGE_SIZE", "100"))
+FEMA_MAX_RECORDS = int(os.getenv("FEMA_MAX_RECORDS", "200")) or None
+FEMA_MAX_CONNECTIONS_PER_HOST = 8
+FEMA_MAX_RETRIES = 5
+FEMA_BACKOFF_BASE = 1.0
+FEMA_BACKOFF_CAP = 60.0
+FEMA_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+fema_session = requests.Session()
+fema_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=FEMA_MAX_CONNECTIONS_PER_HOST))
+fema_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=FEMA_MAX_CONNECTIONS_PER_HOST))
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+class HostLimiter:
+    # caps in-flight requests to one host. additive increase / multiplicative decrease: every success raises the cap by
+    # about one per round of requests, a throttle halves it (at most once a second, so a burst of 429s counts once).
+    # a Retry-After holds every request to the host until it has passed
+    def __init__(self, max_limit):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self.last_cut = 0.0
+        self.cond = threading.Condition()
+
+    def __enter__(self):
+        with self.cond:
+            while True:
+                wait = self.resume_at - time.time()
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    break
+                self.cond.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def succeeded(self):
+        with self.cond:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self.cond.notify_all()
+
+    def throttled(self, retry_after=None):
+        with self.cond:
+            now = time.time()
+            if now - self.last_cut > 1:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_cut = now
+                print(f"Throttled, down to {int(self.limit)} concurrent requests.")
+            if retry_after:
+                self.resume_at = max(self.resume_at, now + retry_after)
+
+def fema_host_limit(url):
+    host = urlsplit(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = HostLimiter(FEMA_MAX_CONNECTIONS_PER_HOST)
+        return _host_limits[host]
+
+class FemaFetchError(Exception):
+    # a page that still failed after every retry. skip is where the pull stopped
+    def __init__(self, message, skip=None):
+        super().__init__(message)
+        self.skip = skip
+
+def fema_backoff(attempt):
+    # full jitter, so pages that failed together don't all come back at the same moment
+    return random.uniform(0, min(FEMA_BACKOFF_CAP, FEMA_BACKOFF_BASE * 2 ** attempt))
+
+def parse_retry_after(value):
+    # either a number of seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def fema_request(url, headers=None):
+    limiter = fema_host_limit(url)
+    for attempt in range(FEMA_MAX_RETRIES + 1):
+        annotate(retries=attempt)
+        try:
+            with limiter:
+                response = fema_session.get(url, headers=headers, timeout=60)
+        except requests.RequestException as e:
+            if attempt == FEMA_MAX_RETRIES:
+                raise
+            delay = fema_backoff(attempt)
+            print(f"{e.__class__.__name__} from fema.gov, retrying in {delay:.1f}s.")
+        else:
+            if response.status_code not in FEMA_RETRY_STATUSES:
+                limiter.succeeded()
+                return response
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if response.status_code in (429, 503):
+                limiter.throttled(retry_after)
+            if attempt == FEMA_MAX_RETRIES:
+                return response
+            delay = retry_after if retry_after is not None else fema_backoff(attempt)
+            print(f"Status code {response.status_code} from fema.gov, retrying in {delay:.1f}s.")
+        time.sleep(delay)
+
+# tracing
+# timing spans around the hot paths: every openFEMA request, the decode / save / convert / index steps, agent builds (that's
+# where the files get uploaded), tool calls and agent-to-agent messages, with bytes, tokens and retries where they apply.
+# finished spans go to a local jsonl file (plus running per-name totals in counters.json next to it) and, when
+# OTEL_EXPORTER_OTLP_ENDPOINT is set, to an OpenTelemetry collector as OTLP/HTTP json. the chat UI shows each request's
+# spans as a breakdown under the conversation
+TRACE_PATH = os.getenv("TRACE_PATH", f"{SALESDOCS_DIR}/.traces/spans.jsonl")
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+TRACE_FLUSH_SECONDS = 2.0
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_open_traces = {}
+_trace_counters = {}
+_trace_lock = threading.Lock()
+_trace_export_lock = threading.Lock()
+_trace_queue = queue.Queue()
+_trace_exporter = None
 
-def cayg_call_api(api_endpoint, max_records=200):
-    all_data = []
-    top = 100
-    skip = 0
+def new_span(name, parent=None, start_ns=None, root=False, **attrs):
+    parent = None if root else (parent or _current_span.get())
+    return {
+        "trace_id": parent["trace_id"] if parent else os.urandom(16).hex(),
+        "span_id": os.urandom(8).hex(),
+        "parent_id": parent["span_id"] if parent else None,
+        "name": name,
+        "start_ns": start_ns or time.time_ns(),
+        "attrs": attrs,
+    }
+
+def end_span(span_record, end_ns=None, error=None):
+    span_record["end_ns"] = end_ns or time.time_ns()
+    span_record["ms"] = round((span_record["end_ns"] - span_record["start_ns"]) / 1e6, 3)
+    if error is not None:
+        span_record["error"] = error
+    with _trace_lock:
+        if span_record["trace_id"] in _open_traces:
+            _open_traces[span_record["trace_id"]].append(span_record)
+        counter = _trace_counters.setdefault(span_record["name"], {"count": 0, "ms": 0.0, "errors": 0})
+        counter["count"] += 1
+        counter["ms"] = round(counter["ms"] + span_record["ms"], 3)
+        counter["errors"] += 1 if span_record.get("error") else 0
+        for key in ("bytes", "tokens", "retries"):
+            if span_record["attrs"].get(key):
+                counter[key] = counter.get(key, 0) + span_record["attrs"][key]
+    start_trace_exporter()
+    _trace_queue.put(dict(span_record))
+
+@contextmanager
+def span(name, **attrs):
+    # yields the span's attrs, so the body can add bytes / records / status as it learns them
+    current = new_span(name, **attrs)
+    token = _current_span.set(current)
+    try:
+        yield current["attrs"]
+    except Exception as e:
+        current["error"] = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(current)
+
+@contextmanager
+def trace(name, **attrs):
+    # a new trace rather than a child of whatever is running. once it ends root["spans"] holds every span in it
+    root = new_span(name, root=True, **attrs)
+    with _trace_lock:
+        _open_traces[root["trace_id"]] = []
+    token = _current_span.set(root)
+    try:
+        yield root
+    except Exception as e:
+        root["error"] = f"{e.__class__.__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(root)
+        with _trace_lock:
+            root["spans"] = _open_traces.pop(root["trace_id"])
+
+def annotate(**attrs):
+    current = _current_span.get()
+    if current is not None:
+        current["attrs"].update(attrs)
+
+def carry_context(fn):
+    # pool threads don't inherit contextvars. this hands them the caller's, so their spans land under the caller's span
+    parent = contextvars.copy_context()
+    return lambda *args, **kwargs: parent.copy().run(fn, *args, **kwargs)
+
+def start_trace_exporter():
+    global _trace_exporter
+    with _trace_lock:
+        if _trace_exporter is None:
+            _trace_exporter = threading.Thread(target=trace_export_loop, name="trace-export", daemon=True)
+            _trace_exporter.start()
+            atexit.register(flush_traces)
+
+def trace_export_loop():
+    # spans wait in the queue, never in here, so the flush at exit always sees everything that's left
     while True:
-        paginated_url = f"{api_endpoint}&$top={top}&$skip={skip}"
-        response = requests.get(paginated_url)
-        if response.status_code == 200:
-            print("API call successful.")
-            data = response.json()['PublicAssistanceApplicantsProgramDeliveries']
-            all_data.extend(data)
-            if len(data) < top:
-                break
-            skip += top
-            if skip >= max_records:
-                break
+        time.sleep(TRACE_FLUSH_SECONDS)
+        flush_traces()
+
+def flush_traces():
+    batch = []
+    while True:
+        try:
+            batch.append(_trace_queue.get_nowait())
+        except queue.Empty:
+            break
+    if batch:
+        export_spans(batch)
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def otlp_payload(spans):
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "sales-agency"}}]},
+        "scopeSpans": [{
+            "scope": {"name": "sales1"},
+            "spans": [{
+                "traceId": span_record["trace_id"],
+                "spanId": span_record["span_id"],
+                "parentSpanId": span_record["parent_id"] or "",
+                "name": span_record["name"],
+                "kind": 1,
+                "startTimeUnixNano": str(span_record["start_ns"]),
+                "endTimeUnixNano": str(span_record["end_ns"]),
+                "attributes": [{"key": key, "value": otlp_value(value)} for key, value in span_record["attrs"].items() if value is not None],
+                "status": {"code": 2, "message": span_record["error"]} if span_record.get("error") else {"code": 1},
+            } for span_record in spans],
+        }],
+    }]}
+
+def export_spans(batch):
+    with _trace_export_lock:
+        try:
+            os.makedirs(os.path.dirname(TRACE_PATH), exist_ok=True)
+            with open(TRACE_PATH, 'a') as trace_file:
+                for span_record in batch:
+                    trace_file.write(json.dumps(span_record, default=str) + "\n")
+            with _trace_lock:
+                counters = json.dumps(_trace_counters, indent=2)
+            _atomic_write(os.path.join(os.path.dirname(TRACE_PATH), "counters.json"), counters)
+        except OSError as e:
+            print(f"Could not write traces to '{TRACE_PATH}': {e}")
+        if OTLP_ENDPOINT:
+            try:
+                requests.post(OTLP_ENDPOINT.rstrip("/") + "/v1/traces", json=otlp_payload(batch), timeout=10)
+            except requests.RequestException as e:
+                print(f"Could not export traces to {OTLP_ENDPOINT}: {e}")
+
+def trace_breakdown(root):
+    # markdown table for the UI: one row per span name, slowest first. times are inclusive, so an agent hop
+    # counts the hops and tool calls it made
+    rows = {}
+    for span_record in root.get("spans", []):
+        if span_record is root or span_record["parent_id"] is None:
+            continue
+        row = rows.setdefault(span_record["name"], {"calls": 0, "ms": 0.0, "bytes": 0, "tokens": 0, "retries": 0, "errors": 0})
+        row["calls"] += 1
+        row["ms"] += span_record["ms"]
+        row["errors"] += 1 if span_record.get("error") else 0
+        for key in ("bytes", "tokens", "retries"):
+            row[key] += span_record["attrs"].get(key) or 0
+    lines = [
+        f"**{root['name']}** took {root['ms'] / 1000:.1f}s",
+        "",
+        "| step | calls | time | bytes | tokens | retries | errors |",
+        "|---|---:|---:|---:|---:|---:|---:|",
+    ]
+    for name, row in sorted(rows.items(), key=lambda item: -item[1]["ms"]):
+        lines.append(f"| {name} | {row['calls']} | {row['ms'] / 1000:.2f}s | {row['bytes']:,} | {row['tokens']:,} | {row['retries']} | {row['errors']} |")
+    return "\n".join(lines)
+
+# http response cache
+# on disk and shared by every process on the host (dev, demo, batch), keyed by the normalised query url. an entry is
+# served as-is for FEMA_HTTP_CACHE_TTL seconds, after that it's revalidated with If-None-Match / If-Modified-Since when
+# the api sent an ETag / Last-Modified. once the cache passes FEMA_HTTP_CACHE_MAX_BYTES the least recently used
+# entries go first. FEMA_HTTP_CACHE=0 turns it off altogether (bench_fema.py does, so it times the wire and not the disk)
+FEMA_HTTP_CACHE = os.getenv("FEMA_HTTP_CACHE", "1") != "0"
+FEMA_HTTP_CACHE_DIR = f"{SALESDOCS_DIR}/.fema_http_cache"
+FEMA_HTTP_CACHE_TTL = 6 * 60 * 60
+FEMA_HTTP_CACHE_MAX_BYTES = 512 * 1024 * 1024
+FEMA_HTTP_CACHE_EVICT_EVERY = 50
+
+class CachedResponse:
+    # just enough of requests.Response for the fetch engine
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+def normalize_url(url):
+    parts = urlsplit(url)
+    params = sorted(unquote(param) for param in parts.query.split("&") if param)
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}{parts.path}?{'&'.join(params)}"
+
+def http_cache_paths(url):
+    key = hashlib.sha256(normalize_url(url).encode()).hexdigest()
+    base = os.path.join(FEMA_HTTP_CACHE_DIR, key[:2], key)
+    return base + ".body", base + ".meta"
+
+def http_cache_read(url):
+    body_path, meta_path = http_cache_paths(url)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        with open(body_path, 'rb') as body_file:
+            return meta, body_file.read()
+    except (OSError, ValueError):
+        # missing, evicted by another process mid-read, or half written: all just a miss
+        return None, None
+
+def _atomic_write(path, data, mode='w'):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode) as tmp_file:
+        tmp_file.write(data)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def file_lock(path):
+    # exclusive across processes for as long as the block runs, taken on a side file next to what it guards
+    with open(path, 'a+b') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
         else:
-            print(f"Failed to fetch data. Status code: {response.status_code}")
+            lock_file.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after 10 seconds
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+_http_cache_writes = 0
+_http_cache_lock = threading.Lock()
+
+def http_cache_write(url, meta, body=None):
+    global _http_cache_writes
+    body_path, meta_path = http_cache_paths(url)
+    os.makedirs(os.path.dirname(body_path), exist_ok=True)
+    if body is not None:
+        _atomic_write(body_path, body, 'wb')
+    _atomic_write(meta_path, json.dumps(meta))
+    with _http_cache_lock:
+        _http_cache_writes += 1
+        evict = _http_cache_writes % FEMA_HTTP_CACHE_EVICT_EVERY == 0
+    if evict:
+        http_cache_evict()
+
+def http_cache_touch(url):
+    # last use is tracked as the body's mtime, which is what eviction sorts on
+    try:
+        os.utime(http_cache_paths(url)[0])
+    except OSError:
+        pass
+
+def http_cache_evict(max_bytes=FEMA_HTTP_CACHE_MAX_BYTES):
+    entries = []
+    for body_path in glob.glob(os.path.join(FEMA_HTTP_CACHE_DIR, "*", "*.body")):
+        try:
+            stat = os.stat(body_path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, body_path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, body_path in sorted(entries):
+        if total <= max_bytes:
             break
-    return {'PublicAssistanceApplicantsProgramDeliveries': all_data}
-
-# Existing parse_data function
-def cayg_parse_data(data):
-    print("Parsing data.")
-    relevant_data = data['PublicAssistanceApplicantsProgramDeliveries']
-    df = pd.DataFrame(relevant_data)
-    return df
-
-cayg_selected_fields = ["declarationType", "stateCode", "disasterNumber", "incidentType", "applicantName", "federalShareObligated"]
-cayg_states_of_interest = ['CA']
-
-cayg_query_url = cayg_build_query(
-    base_url="https://www.fema.gov/api/open",
-    version="v1",
-    entity="PublicAssistanceApplicantsProgramDeliveries",
-    select=cayg_selected_fields,
-    top=100,
-    states=cayg_states_of_interest,
-    federal_share_not_zero=True
-)
+        for path in (body_path, body_path[:-len(".body")] + ".meta"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
 
-def cayg_save_json(data, file_path):
-    with open(file_path, 'w') as json_file:
-        json.dump(data, json_file)
-    print(f"Data saved to '{file_path}'")
-try:
-    cayg_json_file_path = "c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/cayg/processed_pa_data.json"
-    if not os.path.exists(cayg_json_file_path):
-        raw_data = cayg_call_api(cayg_query_url)
-        processed_data = cayg_parse_data(raw_data)
-        processed_data_dict = processed_data.to_dict(orient='records')
-        cayg_save_json(processed_data_dict, cayg_json_file_path)
+def fema_get(url):
+    parts = urlsplit(url)
+    skip = re.search(r"\$skip=(\d+)", parts.query)
+    with span("fema.get", entity=parts.path.rsplit("/", 1)[-1], skip=int(skip.group(1)) if skip else None) as attrs:
+        response = fema_get_cached(url, attrs)
+        attrs.update(status=response.status_code, bytes=len(response.content or b""))
+        return response
+
+def fema_get_cached(url, attrs):
+    if not FEMA_HTTP_CACHE:
+        attrs["cache"] = "off"
+        return fema_request(url)
+    meta, body = http_cache_read(url)
+    headers = {}
+    if meta is not None:
+        if time.time() - meta["stored_at"] < FEMA_HTTP_CACHE_TTL:
+            http_cache_touch(url)
+            attrs["cache"] = "hit"
+            return CachedResponse(200, body)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    response = fema_request(url, headers)
+    if response.status_code == 304 and meta is not None:
+        meta["stored_at"] = time.time()
+        http_cache_write(url, meta)
+        http_cache_touch(url)
+        attrs["cache"] = "revalidated"
+        return CachedResponse(200, body)
+    attrs["cache"] = "miss"
+    if response.status_code == 200:
+        http_cache_write(url, {
+            "url": normalize_url(url),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "stored_at": time.time(),
+        }, response.content)
+    return response
+
+def fema_page_url(api_endpoint, top, skip):
+    # drop any $top/$skip baked in by build_query so the paging params are the only ones sent
+    base, _, query = api_endpoint.partition("?")
+    params = [p for p in query.split("&") if p and not p.startswith(("$top=", "$skip="))]
+    params += [f"$top={top}", f"$skip={skip}"]
+    return base + "?" + "&".join(params)
+
+def fema_count(api_endpoint):
+    # v1 endpoints only understand $inlinecount, v2 and up use $count
+    count_param = "$inlinecount=allpages" if "/v1/" in api_endpoint else "$count=true"
+    try:
+        response = fema_get(fema_page_url(api_endpoint, 1, 0) + f"&{count_param}")
+    except requests.RequestException as e:
+        print(f"Failed to fetch record count: {e}")
+        return None
+    if response.status_code != 200:
+        print(f"Failed to fetch record count. Status code: {response.status_code}")
+        return None
+    return response.json().get('metadata', {}).get('count')
+
+def fema_fetch_page(api_endpoint, entity, top, skip):
+    try:
+        response = fema_get(fema_page_url(api_endpoint, top, skip))
+    except requests.RequestException as e:
+        raise FemaFetchError(f"Failed to fetch data at $skip={skip}: {e}", skip) from e
+    if response.status_code != 200:
+        raise FemaFetchError(f"Failed to fetch data at $skip={skip}. Status code: {response.status_code}", skip)
+    with span("fema.decode", entity=entity, skip=skip) as attrs:
+        page = json_loads(response.content)[entity]
+        attrs["records"] = len(page)
+    return page
+
+def fema_iter_pages(api_endpoint, entity, max_records=200, top=FEMA_PAGE_SIZE, start_skip=0):
+    # generator over the pages in $skip order, starting at start_skip. only FEMA_MAX_CONNECTIONS_PER_HOST pages are ever
+    # in flight or buffered, so memory stays bounded by the page size no matter how large max_records gets.
+    # raises FemaFetchError at the first page that can't be fetched, after every page before it has been yielded
+    total = fema_count(api_endpoint)
+    if total is None:
+        yield from fema_iter_pages_serial(api_endpoint, entity, max_records, top, start_skip)
+        return
+    limit = total if max_records is None else min(total, max_records)
+    skips = iter(range(start_skip, limit, top))
+    print(f"Fetching {limit} of {total} {entity} records" + (f" from $skip={start_skip}." if start_skip else "."))
+
+    @carry_context
+    def fetch(skip):
+        return fema_fetch_page(api_endpoint, entity, top, skip)
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=FEMA_MAX_CONNECTIONS_PER_HOST) as pool:
+        try:
+            for skip in islice(skips, FEMA_MAX_CONNECTIONS_PER_HOST):
+                pending.append(pool.submit(fetch, skip))
+            while pending:
+                page = pending.popleft().result()
+                next_skip = next(skips, None)
+                if next_skip is not None:
+                    pending.append(pool.submit(fetch, next_skip))
+                yield page
+        finally:
+            for future in pending:
+                future.cancel()
+    print("API call successful.")
+
+def fema_iter_pages_serial(api_endpoint, entity, max_records=200, top=FEMA_PAGE_SIZE, start_skip=0):
+    skip = start_skip
+    while max_records is None or skip < max_records:
+        data = fema_fetch_page(api_endpoint, entity, top, skip)
+        print("API call successful.")
+        yield data
+        if len(data) < top:
+            break
+        skip += top
+
+def fema_iter_records(api_endpoint, entity, max_records=200):
+    for page in fema_iter_pages(api_endpoint, entity, max_records):
+        yield from page
+
+def fema_save_stream(records, file_path):
+    # writes a plain json list, one record per line, as the records arrive.
+    # goes through a temp file so a failed pull never leaves a half-written dataset behind
+    tmp_path = file_path + ".tmp"
+    count = 0
+    with span("fema.save", file=os.path.basename(file_path)) as attrs, open(tmp_path, 'w') as json_file:
+        json_file.write("[")
+        for record in records:
+            json_file.write(("\n" if count == 0 else ",\n") + json.dumps(record))
+            count += 1
+        json_file.write("\n]\n")
+        attrs.update(records=count, bytes=json_file.tell())
+    os.replace(tmp_path, file_path)
+    print(f"Saved {count} records to '{file_path}'")
+    return count
+
+def fema_iter_saved(file_path):
+    # reads back a file written by fema_save_stream a record at a time
+    with open(file_path) as json_file:
+        for line in json_file:
+            line = line.strip().rstrip(",")
+            if line and line not in ("[", "]"):
+                yield json_loads(line)
+
+def unique_records(records):
+    seen = set()
+    for record in records:
+        record_id = record.get('id')
+        if record_id is None or record_id not in seen:
+            seen.add(record_id)
+            yield record
+
+def fema_saved_ids(file_path):
+    return {record.get('id') for record in fema_iter_saved(file_path)}
+
+def fema_add_filter(api_endpoint, condition):
+    base, _, query = api_endpoint.partition("?")
+    params = [p for p in query.split("&") if p]
+    for i, param in enumerate(params):
+        if param.startswith("$filter="):
+            params[i] = f"{param} and ({condition})"
+            break
     else:
-        print(f"JSON file already exists at '{cayg_json_file_path}'. Skipping file creation.")
-except Exception as e:
-    print(f"Error occurred: {e}")
+        params.append(f"$filter=({condition})")
+    return base + "?" + "&".join(params)
 
-# New build_query function
-def hm_build_query(base_url, version, entity, select=None, top=None, states=None, federal_share_not_zero=False):
-    query = f"{base_url}/{version}/{entity}"
-    params = []
-    if select:
-        select_query = ','.join(select)
-        params.append(f"$select={select_query}")
-    if top:
-        params.append(f"$top={top}")
-    filter_conditions = []
-    if states:
-        states_query = " or ".join([f"state eq '{state}'" for state in states])
-        filter_conditions.append(f"({states_query})")
-    if federal_share_not_zero:
-        filter_conditions.append("(federalShareObligated gt 0 or federalShareObligated lt 0)")
-    if filter_conditions:
-        filter_query = " and ".join(filter_conditions)
-        params.append(f"$filter={filter_query}")
-    if params:
-        query += "?" + "&".join(params)
-    return query
+# delta sync
+# every dataset file keeps a sidecar with its high-water mark (the newest lastRefresh seen). on startup only the records
+# refreshed since then are pulled and merged in by id, so a warm restart is one small query instead of a full re-download
+# the sidecars live outside the agents' files_folder directories so they never get uploaded for Retrieval.
+# the sidecar also says whether the last full pull finished (complete). a full pull checkpoints every page it finishes,
+# so one that fails or gets killed picks up at the next $skip on the following sync instead of starting over
+FEMA_SYNC_DIR = f"{SALESDOCS_DIR}/.fema_sync"
+FEMA_DATA_DIR = f"{SALESDOCS_DIR}/.fema_data"
 
-def hm_call_api(api_endpoint, max_records=200):
-    all_data = []
-    top = 100
-    skip = 0
-    while True:
-        paginated_url = f"{api_endpoint}&$top={top}&$skip={skip}"
-        response = requests.get(paginated_url)
-        if response.status_code == 200:
-            print("API call successful.")
-            data = response.json()['HazardMitigationAssistanceProjects']
-            all_data.extend(data)
-            if len(data) < top:
-                break
-            skip += top
-            if skip >= max_records:
-                break
+def fema_sync_state_path(file_path):
+    # named after the path under FEMA_DATA_DIR, every dataset has a CA_all.json shard
+    name = os.path.relpath(file_path, FEMA_DATA_DIR).replace(os.sep, "__").replace("/", "__")
+    return os.path.join(FEMA_SYNC_DIR, name + ".sync.json")
+
+def fema_load_sync_state(file_path):
+    state_path = fema_sync_state_path(file_path)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+def fema_save_sync_state(file_path, state):
+    os.makedirs(FEMA_SYNC_DIR, exist_ok=True)
+    state_path = fema_sync_state_path(file_path)
+    with open(state_path + ".tmp", 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+def newer_refresh(high_water, record):
+    refreshed = record.get('lastRefresh')
+    return refreshed if refreshed and (high_water is None or refreshed > high_water) else high_water
+
+def fema_snapshot(api_endpoint, entity, file_path, max_records, state, label):
+    # pages are appended to a .partial file as json lines and the sidecar is checkpointed after each one. the pages are
+    # consumed in $skip order, so what's done is always the prefix below next_skip.
+    # newest first, so a capped pull is the max_records most recently refreshed records (and its high-water mark the
+    # real newest), and records refreshed while a pull is resuming only push older ones to later pages
+    api_endpoint += "&$orderby=lastRefresh desc"
+    partial_path = file_path + ".partial"
+    resume = (state or {}).get('resume')
+    if resume and resume['endpoint'] == api_endpoint and resume['max_records'] == max_records and os.path.exists(partial_path):
+        # cut off anything written after the last checkpoint, e.g. a page that landed just before a crash
+        with open(partial_path, 'r+b') as partial_file:
+            partial_file.truncate(resume['bytes'])
+        print(f"Resuming {label} at $skip={resume['next_skip']}.")
+    else:
+        resume = {'endpoint': api_endpoint, 'max_records': max_records, 'next_skip': 0, 'bytes': 0, 'high_water': None, 'records': 0}
+        open(partial_path, 'wb').close()
+        if (state or {}).get('truncated'):
+            print(f"{label} is capped at {max_records} records, pulling the newest again.")
         else:
-            print(f"Failed to fetch data. Status code: {response.status_code}")
-            break
-    return {'HazardMitigationAssistanceProjects': all_data}
-
-# Existing parse_data function
-def hm_parse_data(data):
-    print("Parsing data.")
-    relevant_data = data['HazardMitigationAssistanceProjects']
-    df = pd.DataFrame(relevant_data)
-    return df
-
-hm_selected_fields = ["programArea", "programFy","state", "disasterNumber", "recipient", "federalShareObligated"]
-hm_states_of_interest = ['California']
-
-hm_query_url = hm_build_query(
-    base_url="https://www.fema.gov/api/open",
-    version="v3",
-    entity="HazardMitigationAssistanceProjects",
-    select=hm_selected_fields,
-    top=100,
-    states=hm_states_of_interest,
-    federal_share_not_zero=True
-)
+            print(f"No complete local copy of {label}, pulling a full snapshot.")
+    complete = True
+    with open(partial_path, 'ab') as partial_file:
+        try:
+            for page in fema_iter_pages(api_endpoint, entity, max_records, start_skip=resume['next_skip']):
+                for record in page:
+                    partial_file.write((json.dumps(record) + "\n").encode())
+                    resume['high_water'] = newer_refresh(resume['high_water'], record)
+                partial_file.flush()
+                resume['next_skip'] += FEMA_PAGE_SIZE
+                resume['bytes'] = partial_file.tell()
+                resume['records'] += len(page)
+                fema_save_sync_state(file_path, {'high_water': resume['high_water'], 'records': resume['records'], 'complete': False, 'resume': resume})
+        except FemaFetchError as e:
+            complete = False
+            print(f"{e} {label} is incomplete, the next sync resumes at $skip={resume['next_skip']}.")
+    # a copy that hit the cap is a sample, not the dataset. a delta against it would pull every newer record there is,
+    # so it's pulled as a capped snapshot again next time instead (two or three pages, revalidated by the http cache)
+    truncated = max_records is not None and resume['records'] >= max_records
+    if (complete and truncated and (state or {}).get('truncated') and state.get('high_water') == resume['high_water']
+            and os.path.exists(file_path) and fema_saved_ids(partial_path) == fema_saved_ids(file_path)):
+        # the same newest records as last time: the copy stays as it is, so its mtime doesn't set off the parquet,
+        # index, lead table and profile rebuilds downstream
+        count = state['records']
+        print(f"{label} hasn't changed since the last pull.")
+    else:
+        # an incomplete pull still leaves whatever made it as the dataset, the sidecar is what says it isn't finished.
+        # a record refreshed upstream between attempts jumps to the front and shifts the rest down a place, so the
+        # resumed pages can repeat rows already in the .partial; the first copy of each id is the one kept
+        count = fema_save_stream(unique_records(fema_iter_saved(partial_path)), file_path)
+    if complete:
+        os.remove(partial_path)
+    fema_save_sync_state(file_path, {'high_water': resume['high_water'], 'records': count, 'complete': complete, 'truncated': truncated, 'resume': None if complete else resume})
+    return count
 
-def hm_save_json(data, file_path):
-    with open(file_path, 'w') as json_file:
-        json.dump(data, json_file)
-    print(f"Data saved to '{file_path}'")
-try:
-    hm_json_file_path = "c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/hma/processed_hm_data.json"
+def fema_sync(api_endpoint, entity, file_path, max_records=FEMA_MAX_RECORDS):
+    with span("fema.sync", entity=entity, file=os.path.basename(file_path)):
+        return fema_sync_file(api_endpoint, entity, file_path, max_records)
+
+def fema_sync_file(api_endpoint, entity, file_path, max_records=FEMA_MAX_RECORDS):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    state = fema_load_sync_state(file_path)
+    label = f"{entity} {os.path.splitext(os.path.basename(file_path))[0]}"
 
-    if not os.path.exists(hm_json_file_path):
-        raw_data = hm_call_api(hm_query_url)
-        processed_data = hm_parse_data(raw_data)
-        processed_data_dict = processed_data.to_dict(orient='records')
-        hm_save_json(processed_data_dict, hm_json_file_path)
+    # sidecars from before the complete flag only ever got written after a finished pull
+    if state is None or not state.get('complete', True) or state.get('truncated') or not state.get('high_water') or not os.path.exists(file_path):
+        return fema_snapshot(api_endpoint, entity, file_path, max_records, state, label)
     else:
-        print(f"JSON file already exists at '{hm_json_file_path}'. Skipping file creation.")
-except Exception as e:
-    print(f"Error occurred: {e}")
+        # ordered by lastRefresh, so the records are consumed a timestamp at a time. a pull that stops early only moves
+        # the high-water mark up to the last timestamp it saw all of, and gt rather than ge then picks up exactly
+        # where it left off without pulling the boundary records again every sync
+        delta_endpoint = fema_add_filter(api_endpoint, f"lastRefresh gt '{state['high_water']}'") + "&$orderby=lastRefresh"
+        high_water = seen = state['high_water']
+        changed = {}
+        pulled = 0
+        try:
+            # capped like the snapshot, so the delta never holds more than max_records in memory
+            for record in fema_iter_records(delta_endpoint, entity, max_records=max_records):
+                pulled += 1
+                if record.get('lastRefresh') and record['lastRefresh'] != seen:
+                    high_water = seen
+                    seen = newer_refresh(seen, record)
+                changed[record['id']] = record
+            high_water = seen
+        except FemaFetchError as e:
+            print(f"{e} Merging the {len(changed)} {label} records pulled so far, the rest comes with the next sync.")
+        if max_records is not None and pulled >= max_records:
+            # more changed than the cap holds: merged in, the copy would outgrow max_records, so take the newest instead
+            return fema_snapshot(api_endpoint, entity, file_path, max_records, {'truncated': True}, label)
+        # a refreshed record can come back identical, so drop anything we already hold unchanged before rewriting
+        for record in fema_iter_saved(file_path):
+            if changed.get(record.get('id')) == record:
+                del changed[record['id']]
+        if not changed:
+            print(f"{label} is up to date as of {state['high_water']}.")
+            return state['records']
+
+        def merged():
+            for record in fema_iter_saved(file_path):
+                yield changed.pop(record.get('id'), record)
+            yield from changed.values()
+
+        print(f"Merging {len(changed)} changed {label} records.")
+        count = fema_save_stream(merged(), file_path)
+    fema_save_sync_state(file_path, {'high_water': high_water, 'records': count, 'complete': True, 'resume': None})
+    return count
+
+# coverage
+# which states (postal codes) and fiscal years get pulled. every state by default, FEMA_STATES=CA,OR,WA in the .env narrows it.
+# FEMA_FISCAL_YEARS=2021,2022,2023 splits the datasets that have a fiscal_year_field into a shard per year
+US_STATES = {
+    "AL": "Alabama", "AK": "Alaska", "AZ": "Arizona", "AR": "Arkansas", "CA": "California", "CO": "Colorado",
+    "CT": "Connecticut", "DE": "Delaware", "DC": "District of Columbia", "FL": "Florida", "GA": "Georgia",
+    "HI": "Hawaii", "ID": "Idaho", "IL": "Illinois", "IN": "Indiana", "IA": "Iowa", "KS": "Kansas",
+    "KY": "Kentucky", "LA": "Louisiana", "ME": "Maine", "MD": "Maryland", "MA": "Massachusetts", "MI": "Michigan",
+    "MN": "Minnesota", "MS": "Mississippi", "MO": "Missouri", "MT": "Montana", "NE": "Nebraska", "NV": "Nevada",
+    "NH": "New Hampshire", "NJ": "New Jersey", "NM": "New Mexico", "NY": "New York", "NC": "North Carolina",
+    "ND": "North Dakota", "OH": "Ohio", "OK": "Oklahoma", "OR": "Oregon", "PA": "Pennsylvania",
+    "RI": "Rhode Island", "SC": "South Carolina", "SD": "South Dakota", "TN": "Tennessee", "TX": "Texas",
+    "UT": "Utah", "VT": "Vermont", "VA": "Virginia", "WA": "Washington", "WV": "West Virginia",
+    "WI": "Wisconsin", "WY": "Wyoming",
+}
+FEMA_STATES = [state.strip().upper() for state in os.getenv("FEMA_STATES", ",".join(US_STATES)).split(",") if state.strip()]
+FEMA_FISCAL_YEARS = [int(year) for year in os.getenv("FEMA_FISCAL_YEARS", "").split(",") if year.strip()]
 
-# New build_query function
-def preparedness_build_query(base_url, version, entity, select=None, top=None, states=None):
+# dataset registry
+# every openFEMA dataset the agency ingests is described here and driven through the one engine above.
+# adding a dataset (disaster declarations, IHP, ...) is a new entry here, not new code. keys:
+#   entity        openFEMA entity name, also the response key unless response_key says otherwise
+#   version       api version the entity lives under
+#   select        fields to pull ($select); keep id and lastRefresh in there, delta sync depends on them
+#   state_field   field the states are filtered on (stateCode for PA, state for most others)
+#   state_format  "code" when state_field holds postal codes, "name" when it holds full state names
+#   states        optional, postal codes to pull instead of FEMA_STATES
+#   filters       any extra OData conditions, and-ed onto the state filter
+#   data_dir      where the synced shards are kept. this is the raw pull and stays out of the agents' files_folder
+#   dtypes        column types for the columnar copy: category for strings that repeat a lot (states, incident types,
+#                 applicant names, refresh dates), float64/int64 for numbers. anything not listed is stored as a plain string
+#   name_field    who the lead is (applicant, recipient, agency)
+#   amount_field  the dollar column leads are ranked on
+#   disaster_field / fiscal_year_field
+#                 optional, when the dataset has them
+#   trend_field   optional, year (or date) field the lead profiles bucket funding by for the trend
+#   indexed       columns the local query index gets an index on
+#   leads_path    where the ranked lead table is written (inside the analyst's files_folder, so that's what gets uploaded)
+fema_datasets = {
+    "cayg": {
+        "entity": "PublicAssistanceApplicantsProgramDeliveries",
+        "version": "v1",
+        "select": ["id", "lastRefresh", "declarationType", "stateCode", "disasterNumber", "incidentType", "applicantName", "federalShareObligated"],
+        "state_field": "stateCode",
+        "state_format": "code",
+        "filters": ["(federalShareObligated gt 0 or federalShareObligated lt 0)"],
+        "data_dir": f"{FEMA_DATA_DIR}/cayg",
+        "dtypes": {"lastRefresh": "category", "declarationType": "category", "stateCode": "category", "incidentType": "category", "applicantName": "category", "disasterNumber": "int64", "federalShareObligated": "float64"},
+        "name_field": "applicantName",
+        "amount_field": "federalShareObligated",
+        "disaster_field": "disasterNumber",
+        "indexed": ["stateCode", "disasterNumber", "applicantName"],
+        "leads_path": f"{SALESDOCS_DIR}/cayg/cayg_leads.json",
+    },
+    "hma": {
+        "entity": "HazardMitigationAssistanceProjects",
+        "version": "v3",
+        "select": ["id", "lastRefresh", "programArea", "programFy", "state", "disasterNumber", "recipient", "federalShareObligated"],
+        "state_field": "state",
+        "state_format": "name",
+        "filters": ["(federalShareObligated gt 0 or federalShareObligated lt 0)"],
+        "data_dir": f"{FEMA_DATA_DIR}/hma",
+        "dtypes": {"lastRefresh": "category", "programArea": "category", "programFy": "int64", "state": "category", "recipient": "category", "disasterNumber": "int64", "federalShareObligated": "float64"},
+        "name_field": "recipient",
+        "amount_field": "federalShareObligated",
+        "disaster_field": "disasterNumber",
+        "fiscal_year_field": "programFy",
+        "trend_field": "programFy",
+        "indexed": ["state", "disasterNumber", "recipient", "programFy"],
+        "leads_path": f"{SALESDOCS_DIR}/hma/hma_leads.json",
+    },
+    "preparedness": {
+        "entity": "EmergencyManagementPerformanceGrants",
+        "version": "v2",
+        "select": ["id", "lastRefresh", "state", "legalAgencyName", "projectEndDate", "fundingAmount"],
+        "state_field": "state",
+        "state_format": "name",
+        "filters": [],
+        "data_dir": f"{FEMA_DATA_DIR}/preparedness",
+        "dtypes": {"lastRefresh": "category", "state": "category", "legalAgencyName": "category", "projectEndDate": "category", "fundingAmount": "float64"},
+        "name_field": "legalAgencyName",
+        "amount_field": "fundingAmount",
+        "trend_field": "projectEndDate",
+        "indexed": ["state", "legalAgencyName"],
+        "leads_path": f"{SALESDOCS_DIR}/preparedness/preparedness_leads.json",
+    },
+}
+
+def build_query(base_url, version, entity, select=None, top=None, state_field="state", states=None, filters=None):
     query = f"{base_url}/{version}/{entity}"
     params = []
     if select:
@@ -192,8 +902,10 @@ def preparedness_build_query(base_url, version, entity, select=None, top=None, s
         params.append(f"$top={top}")
     filter_conditions = []
     if states:
-        states_query = " or ".join([f"state eq '{state}'" for state in states])
+        states_query = " or ".join([f"{state_field} eq '{state}'" for state in states])
         filter_conditions.append(f"({states_query})")
+    if filters:
+        filter_conditions.extend(filters)
     if filter_conditions:
         filter_query = " and ".join(filter_conditions)
         params.append(f"$filter={filter_query}")
@@ -201,65 +913,964 @@ def preparedness_build_query(base_url, version, entity, select=None, top=None, s
         query += "?" + "&".join(params)
     return query
 
-def preparedness_call_api(api_endpoint, max_records=200):
-    all_data = []
-    top = 100
-    skip = 0
-    while True:
-        paginated_url = f"{api_endpoint}&$top={top}&$skip={skip}"
-        response = requests.get(paginated_url)
-        if response.status_code == 200:
-            print("API call successful.")
-            data = response.json()['EmergencyManagementPerformanceGrants']
-            all_data.extend(data)
-            if len(data) < top:
-                break
-            skip += top
-            if skip >= max_records:
+def dataset_query_url(spec, states=None, year=None):
+    states = spec.get("states", FEMA_STATES) if states is None else states
+    if spec.get("state_format") == "name":
+        states = [US_STATES.get(state, state) for state in states]
+    filters = list(spec.get("filters") or [])
+    if year is not None:
+        filters.append(f"({spec['fiscal_year_field']} eq {year})")
+    return build_query(
+        base_url=spec.get("base_url", FEMA_BASE_URL),
+        version=spec["version"],
+        entity=spec["entity"],
+        select=spec.get("select"),
+        top=FEMA_PAGE_SIZE,
+        state_field=spec.get("state_field", "state"),
+        states=states,
+        filters=filters,
+    )
+
+def response_key(spec):
+    return spec.get("response_key", spec["entity"])
+
+# shards
+# a dataset is pulled as one shard per (state, fiscal year) instead of one query with a long or-filter. every shard pages,
+# delta-syncs and converts on its own, so they all run side by side, and the readers below merge them back together
+FEMA_SHARD_WORKERS = 16
+
+def dataset_shards(spec):
+    years = FEMA_FISCAL_YEARS if spec.get("fiscal_year_field") and FEMA_FISCAL_YEARS else [None]
+    shards = []
+    for state in spec.get("states", FEMA_STATES):
+        for year in years:
+            shard_name = f"{state}_{year if year is not None else 'all'}"
+            shards.append({
+                "state": state,
+                "year": year,
+                "json_path": f"{spec['data_dir']}/json/{shard_name}.json",
+                "parquet_path": f"{spec['data_dir']}/parquet/{shard_name}.parquet",
+            })
+    return shards
+
+def shard_paths(spec):
+    return [shard["json_path"] for shard in dataset_shards(spec) if os.path.exists(shard["json_path"])]
+
+def iter_dataset_records(spec):
+    for path in shard_paths(spec):
+        yield from fema_iter_saved(path)
+
+def incomplete_shards(spec):
+    return [shard for shard in dataset_shards(spec) if not (fema_load_sync_state(shard["json_path"]) or {}).get('complete', False)]
+
+def dataset_mtime(spec):
+    return max((os.path.getmtime(path) for path in shard_paths(spec)), default=0.0)
+
+def sync_shard(spec, shard, max_records=FEMA_MAX_RECORDS):
+    try:
+        api_endpoint = dataset_query_url(spec, [shard["state"]], shard["year"])
+        return fema_sync(api_endpoint, response_key(spec), shard["json_path"], max_records)
+    except Exception as e:
+        print(f"Error occurred syncing '{shard['json_path']}': {e}")
+
+# columnar copies
+# every synced json shard gets a typed parquet twin (categoricals dictionary-encoded, obligations as float64).
+# readers memory-map the shards and only decode the columns and row groups they ask for, instead of json-decoding everything.
+# needs pyarrow; without it the json copy is all there is and readers fall back to it
+PARQUET_CHUNK_ROWS = 50000
+
+def columnar_schema(spec):
+    arrow_types = {
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        "float64": pa.float64(),
+        "int64": pa.int64(),
+    }
+    dtypes = spec.get("dtypes", {})
+    return pa.schema([(field, arrow_types.get(dtypes.get(field), pa.string())) for field in spec["select"]])
+
+class RecordColumns:
+    # records decode straight into one compact array per field instead of piling up as dicts: category fields as int32
+    # codes into a dictionary of their distinct values, floats in array('d'), ints in array('q') with a null mask and
+    # everything else as a plain list of strings. frame() hands the buffers to pandas without building any rows
+    def __init__(self, spec):
+        self.fields = spec["select"]
+        self.dtypes = spec.get("dtypes", {})
+        self.columns = {}
+        self.masks = {}
+        self.dictionaries = {}
+        self.rows = 0
+        self._appenders = [(field, self._appender(field)) for field in self.fields]
+
+    def _appender(self, field):
+        dtype = self.dtypes.get(field)
+        if dtype == "float64":
+            column = self.columns[field] = array('d')
+
+            def append(value):
+                try:
+                    column.append(float(value))
+                except (TypeError, ValueError):
+                    column.append(float("nan"))
+        elif dtype == "int64":
+            column = self.columns[field] = array('q')
+            mask = self.masks[field] = bytearray()
+
+            def append(value):
+                try:
+                    column.append(int(value))
+                    mask.append(0)
+                except (TypeError, ValueError, OverflowError):
+                    column.append(0)
+                    mask.append(1)
+        elif dtype == "category":
+            column = self.columns[field] = array('i')
+            dictionary = self.dictionaries[field] = {}
+
+            def append(value):
+                if value is None:
+                    column.append(-1)
+                    return
+                code = dictionary.get(value)
+                if code is None:
+                    code = dictionary[value] = len(dictionary)
+                column.append(code)
+        else:
+            column = self.columns[field] = []
+            append = column.append
+        return append
+
+    def append(self, record):
+        get = record.get
+        for field, append in self._appenders:
+            append(get(field))
+        self.rows += 1
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+        return self
+
+    def frame(self):
+        data = {}
+        for field in self.fields:
+            column = self.columns[field]
+            dtype = self.dtypes.get(field)
+            if dtype == "category":
+                codes = np.frombuffer(column, dtype=np.int32) if self.rows else np.empty(0, dtype=np.int32)
+                data[field] = pd.Categorical.from_codes(codes, categories=list(self.dictionaries[field]))
+            elif dtype == "float64":
+                data[field] = np.frombuffer(column, dtype=np.float64) if self.rows else np.empty(0, dtype=np.float64)
+            elif dtype == "int64":
+                values = np.frombuffer(column, dtype=np.int64) if self.rows else np.empty(0, dtype=np.int64)
+                mask = np.frombuffer(self.masks[field], dtype=np.bool_) if self.rows else np.empty(0, dtype=np.bool_)
+                data[field] = pd.arrays.IntegerArray(values, mask)
+            else:
+                data[field] = column if self.rows else np.empty(0, dtype=object)
+        return pd.DataFrame(data, columns=self.fields)
+
+def typed_frame(spec, records):
+    return RecordColumns(spec).extend(records).frame()
+
+def columnar_stale(spec, shard):
+    json_path, parquet_path = shard["json_path"], shard["parquet_path"]
+    if not os.path.exists(json_path):
+        return False
+    if not os.path.exists(parquet_path) or os.path.getmtime(parquet_path) < os.path.getmtime(json_path):
+        return True
+    # a dtypes change in the registry rewrites the copy too, the shards have to agree to be read as one table
+    return pa is not None and not pq.read_schema(parquet_path).equals(columnar_schema(spec))
+
+def save_columnar(spec, shard):
+    if pa is None:
+        return None
+    parquet_path = shard["parquet_path"]
+    if not columnar_stale(spec, shard):
+        return parquet_path
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+    schema = columnar_schema(spec)
+    records = fema_iter_saved(shard["json_path"])
+    # written a chunk at a time so converting a big dataset never holds more than PARQUET_CHUNK_ROWS rows
+    with pq.ParquetWriter(parquet_path + ".tmp", schema) as writer:
+        while True:
+            chunk = typed_frame(spec, islice(records, PARQUET_CHUNK_ROWS))
+            if chunk.empty:
                 break
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+    os.replace(parquet_path + ".tmp", parquet_path)
+    print(f"Saved columnar copy to '{parquet_path}'")
+    return parquet_path
+
+def save_columnar_shards(jobs):
+    stale = [(spec, shard) for spec, shard in jobs if columnar_stale(spec, shard)]
+    if pa is None or not stale:
+        return
+    with span("parse.columnar", shards=len(stale)):
+        convert_shards(stale)
+
+def convert_shards(stale):
+    if len(stale) == 1:
+        save_columnar(*stale[0])
+        return
+    # the conversion is pandas work that holds the GIL, so the shards go to a process pool. spawn rather than fork,
+    # this runs on a startup thread and forking a process with other threads running can deadlock the child
+    workers = min(len(stale), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as parse_pool:
+        futures = {parse_pool.submit(save_columnar, spec, shard): shard for spec, shard in stale}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error occurred converting '{futures[future]['json_path']}': {e}")
+
+FILTER_OPS = {
+    "==": operator.eq, "=": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge,
+}
+
+def filter_mask(column, op, value):
+    # the json fallback's take on a pyarrow predicate, nulls never match
+    if op in ("in", "not in"):
+        mask = column.isin(value)
+        return (~mask & column.notna()) if op == "not in" else mask
+    if op not in FILTER_OPS:
+        raise ValueError(f"Unsupported filter op '{op}', use one of {', '.join(list(FILTER_OPS) + ['in', 'not in'])}")
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # unordered categories only compare for equality
+        column = column.astype(column.cat.categories.dtype)
+    return FILTER_OPS[op](column, value).fillna(False).astype(bool)
+
+def read_columns(spec, columns=None, filters=None):
+    # columns projects, filters are pyarrow predicates pushed down to the row groups, e.g. [("stateCode", "==", "CA")]
+    # the shards are read back as one table. the parquet copy is only used while every shard's is current; after a
+    # failed conversion the json is the one with the latest data
+    shards = [shard for shard in dataset_shards(spec) if os.path.exists(shard["json_path"])]
+    if pa is not None and shards and not any(columnar_stale(spec, shard) for shard in shards):
+        return pd.read_parquet([shard["parquet_path"] for shard in shards], columns=columns, filters=filters, memory_map=True)
+    df = typed_frame(spec, iter_dataset_records(spec))
+    for field, op, value in filters or []:
+        df = df[filter_mask(df[field], op, value)]
+    return df[columns] if columns else df
+
+def read_dataset(name, columns=None, filters=None):
+    return read_columns(fema_datasets[name], columns, filters)
+
+# local query index
+# one sqlite file with a table per dataset, indexed on the registry's indexed columns. the FemaQuery tool answers
+# filter / sort / aggregate questions against it in-process and hands back only the matching rows
+FEMA_DB_PATH = f"{FEMA_DATA_DIR}/fema.sqlite"
+_fema_db_lock = threading.Lock()
+
+def fema_db_connect():
+    db = sqlite3.connect(FEMA_DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+def sql_type(spec, field):
+    return {"float64": "REAL", "int64": "INTEGER"}.get(spec.get("dtypes", {}).get(field), "TEXT")
+
+def save_query_index(name):
+    with span("index.build", dataset=name):
+        build_query_index(name)
+
+def build_query_index(name):
+    spec = fema_datasets[name]
+    fields = spec["select"]
+    source_mtime = dataset_mtime(spec)
+    if not source_mtime:
+        return
+    with _fema_db_lock, closing(fema_db_connect()) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS _synced (dataset TEXT PRIMARY KEY, source_mtime REAL)")
+        row = db.execute("SELECT source_mtime FROM _synced WHERE dataset = ?", (name,)).fetchone()
+        if row and row[0] >= source_mtime:
+            return
+        # rebuilt inside one transaction, so a query running alongside sees either the old table or the new one
+        db.execute("BEGIN")
+        try:
+            db.execute(f'DROP TABLE IF EXISTS "{name}"')
+            columns = ", ".join(f'"{field}" {sql_type(spec, field)}' for field in fields)
+            db.execute(f'CREATE TABLE "{name}" ({columns})')
+            insert = f'INSERT INTO "{name}" VALUES ({", ".join("?" * len(fields))})'
+            # streamed row by row straight from the json, nothing is held in between
+            db.executemany(insert, (tuple(map(record.get, fields)) for record in iter_dataset_records(spec)))
+            for field in spec.get("indexed", []):
+                collate = " COLLATE NOCASE" if sql_type(spec, field) == "TEXT" else ""
+                db.execute(f'CREATE INDEX "{name}_{field}_idx" ON "{name}" ("{field}"{collate})')
+            db.execute("INSERT OR REPLACE INTO _synced VALUES (?, ?)", (name, source_mtime))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    print(f"Indexed {name} in '{FEMA_DB_PATH}'")
+
+# lead tables
+# the analysts used to run Retrieval over the raw dumps to find the biggest obligations. instead the synced dataset is
+# rolled up once here (total per state + lead, biggest disaster, project count) and only the top LEADS_TOP_N per state
+# are handed to the agents, either as the uploaded leads file or through the LeadLookup tool
+LEADS_TOP_N = 50
+
+def build_lead_table(spec, top_n=LEADS_TOP_N):
+    state_field, name_field, amount_field = spec.get("state_field", "state"), spec["name_field"], spec["amount_field"]
+    disaster_field = spec.get("disaster_field")
+    columns = [state_field, name_field, amount_field] + ([disaster_field] if disaster_field else [])
+    df = read_columns(spec, columns=columns)
+    df[amount_field] = df[amount_field].fillna(0.0)
+    group = [state_field, name_field]
+
+    table = df.groupby(group, sort=False, observed=True).agg(
+        totalObligated=(amount_field, "sum"),
+        records=(amount_field, "size"),
+    )
+    if disaster_field:
+        by_disaster = df.groupby(group + [disaster_field], sort=False, observed=True)[amount_field].sum().reset_index()
+        table["disasters"] = by_disaster.groupby(group, sort=False, observed=True)[disaster_field].nunique()
+        largest = by_disaster.sort_values(amount_field, ascending=False).drop_duplicates(group).set_index(group)
+        table["largestDisaster"] = largest[disaster_field]
+        table["largestDisasterObligated"] = largest[amount_field]
+    table = table.reset_index()
+    table["rank"] = table.groupby(state_field, observed=True)["totalObligated"].rank(method="first", ascending=False).astype(int)
+    return table[table["rank"] <= top_n].sort_values([state_field, "rank"]).reset_index(drop=True)
+
+def lead_table_copies(leads_path):
+    # agency_swarm renames a file to <name>_<file id><ext> once it's uploaded, so look for those copies too
+    stem, ext = os.path.splitext(leads_path)
+    return glob.glob(f"{glob.escape(stem)}_file-*{ext}") + ([leads_path] if os.path.exists(leads_path) else [])
+
+def save_lead_table(name):
+    spec = fema_datasets[name]
+    leads_path = spec["leads_path"]
+    copies = lead_table_copies(leads_path)
+    if copies and max(os.path.getmtime(copy) for copy in copies) >= dataset_mtime(spec):
+        return leads_path
+    with span("leads.build", dataset=name) as attrs:
+        table = build_lead_table(spec)
+        attrs["records"] = len(table)
+    for copy in copies:
+        os.remove(copy)
+    os.makedirs(os.path.dirname(leads_path), exist_ok=True)
+    with open(leads_path, 'w') as json_file:
+        json.dump(table.to_dict(orient='records'), json_file, default=str)
+    print(f"Saved {len(table)} ranked {name} leads to '{leads_path}'")
+    return leads_path
+
+# lead profiles
+# the datasets name the same lead differently ("City of Tulsa" in one, "TULSA, CITY OF" in another) and each analyst only
+# sees its own, so nobody had the whole federal funding picture for a lead. here the names are normalised to a sorted
+# token key, linked across datasets within a state (fuzzy, through rapidfuzz, when it's installed) and rolled up into one
+# profile per lead: per-program totals, a yearly funding trend and a composite lead score. profiles live in the query
+# index next to the dataset tables, so the LeadProfile tool answers with a single lookup
+LEAD_PROFILES_TABLE = "lead_profiles"
+LEAD_MATCH_THRESHOLD = 92
+LEAD_TREND_YEARS = 3
+# score = funding rank within the state, how many programs the lead shows up in, and whether funding is growing
+LEAD_SCORE_WEIGHTS = {"funding": 0.5, "programs": 0.3, "trend": 0.2}
+NAME_NOISE_WORDS = {"the", "of", "and", "inc", "llc", "co"}
+STATE_CODES = {**{code.lower(): code for code in US_STATES}, **{state.lower(): code for code, state in US_STATES.items()}}
+
+def name_key(name):
+    tokens = set(re.findall(r"[a-z0-9]+", str(name).lower())) - NAME_NOISE_WORDS
+    return " ".join(sorted(tokens))
+
+def state_code(state):
+    return STATE_CODES.get(str(state).strip().lower())
+
+def category_map(values, fn):
+    # applies fn once per distinct value instead of once per row
+    values = values.astype("category")
+    mapped = np.array([fn(value) for value in values.cat.categories] + [None], dtype=object)
+    return mapped[values.cat.codes.to_numpy()]
+
+def profile_rows(name):
+    # one row per (state, name key) for a dataset, plus its funding per year when the dataset has a trend_field
+    spec = fema_datasets[name]
+    state_field, name_field, amount_field = spec.get("state_field", "state"), spec["name_field"], spec["amount_field"]
+    trend_field = spec.get("trend_field")
+    df = read_columns(spec, columns=[state_field, name_field, amount_field] + ([trend_field] if trend_field else []))
+    df = pd.DataFrame({
+        "state": category_map(df[state_field], state_code),
+        "key": category_map(df[name_field], name_key),
+        "name": df[name_field].astype(str).to_numpy(),
+        "amount": df[amount_field].fillna(0.0).to_numpy(),
+        "year": pd.to_numeric(df[trend_field].astype(str).str[:4], errors="coerce").to_numpy() if trend_field else np.nan,
+    })
+    df = df[df["state"].notna() & (df["key"].fillna("") != "")]
+    totals = df.groupby(["state", "key", "name"], sort=False)["amount"].agg(["sum", "size"]).reset_index()
+    # a key's display name is whichever of its spellings carries the most money
+    totals = totals.sort_values("sum", ascending=False)
+    rows = totals.groupby(["state", "key"], sort=False).agg(
+        name=("name", "first"), total=("sum", "sum"), records=("size", "sum"), aliases=("name", list)).reset_index()
+    rows["dataset"] = name
+    years = df.dropna(subset=["year"]).groupby(["state", "key", "year"], sort=False)["amount"].sum().reset_index()
+    return rows, years
+
+def link_names(keys_by_dataset):
+    # union-find over name keys in one state; names from different datasets are linked when they're each other's best
+    # fuzzy match, score at least LEAD_MATCH_THRESHOLD and carry the same numbers ("district 4" never matches "district 5")
+    parent = {}
+    def find(key):
+        while parent.get(key, key) != key:
+            key = parent[key]
+        return key
+    if fuzz_process is None:
+        return find
+    datasets = list(keys_by_dataset)
+    for i, left_name in enumerate(datasets):
+        for right_name in datasets[i + 1:]:
+            left = sorted(keys_by_dataset[left_name] - keys_by_dataset[right_name])
+            right = sorted(keys_by_dataset[right_name] - keys_by_dataset[left_name])
+            if not left or not right:
+                continue
+            scores = fuzz_process.cdist(left, right, scorer=fuzz.ratio, score_cutoff=LEAD_MATCH_THRESHOLD, dtype=np.uint8, workers=-1)
+            best_right = scores.argmax(axis=1)
+            best_left = scores.argmax(axis=0)
+            for row in np.flatnonzero((scores[np.arange(len(left)), best_right] > 0) & (best_left[best_right] == np.arange(len(left)))):
+                a, b = left[row], right[best_right[row]]
+                if re.findall(r"\d+", a) == re.findall(r"\d+", b):
+                    parent[find(b)] = find(a)
+    return find
+
+def build_lead_profiles(names):
+    parts = [profile_rows(name) for name in names]
+    rows = pd.concat([part[0] for part in parts], ignore_index=True)
+    years = pd.concat([part[1] for part in parts], ignore_index=True)
+    rows["lead"] = rows["key"]
+    for state, state_rows in rows.groupby("state", sort=False):
+        find = link_names({name: set(group["key"]) for name, group in state_rows.groupby("dataset", sort=False)})
+        rows.loc[state_rows.index, "lead"] = state_rows["key"].map(find)
+    lead_of = rows.drop_duplicates(["state", "key"]).set_index(["state", "key"])["lead"]
+    years["lead"] = lead_of.reindex(pd.MultiIndex.from_frame(years[["state", "key"]])).to_numpy()
+
+    group = ["state", "lead"]
+    rows = rows.sort_values("total", ascending=False)
+    profiles = rows.groupby(group, sort=False).agg(name=("name", "first"), totalFunding=("total", "sum"), records=("records", "sum"), programs=("dataset", "nunique"))
+    per_program = rows.pivot_table(index=group, columns="dataset", values="total", aggfunc="sum", fill_value=0.0)
+    for name in names:
+        profiles[f"{name}Total"] = per_program[name] if name in per_program else 0.0
+    aliases = {}
+    for (state, lead, dataset), names_seen in zip(rows[["state", "lead", "dataset"]].itertuples(index=False, name=None), rows["aliases"]):
+        aliases.setdefault((state, lead), {}).setdefault(dataset, set()).update(names_seen)
+    profiles["aliases"] = [json.dumps({dataset: sorted(names_seen) for dataset, names_seen in aliases[lead].items()}) for lead in profiles.index]
+    profiles["search"] = rows.groupby(group, sort=False)["key"].agg(lambda keys: " | ".join(sorted(set(keys))))
+
+    # trend: funding in the last LEAD_TREND_YEARS years of data against the years before that
+    by_year = years.groupby(group + ["year"])["amount"].sum().reset_index()
+    trend = {}
+    for state, lead, year, amount in by_year[group + ["year", "amount"]].itertuples(index=False, name=None):
+        trend.setdefault((state, lead), {})[int(year)] = round(float(amount), 2)
+    # {year: funding}; no trend_field data at all (only cayg synced, say) leaves every lead with an empty trend
+    profiles["trend"] = [json.dumps(trend.get(lead, {})) for lead in profiles.index]
+    latest = by_year["year"].max() if len(by_year) else 0
+    recent = by_year[by_year["year"] > latest - LEAD_TREND_YEARS].groupby(group)["amount"].sum()
+    prior = by_year[(by_year["year"] <= latest - LEAD_TREND_YEARS) & (by_year["year"] > latest - 2 * LEAD_TREND_YEARS)].groupby(group)["amount"].sum()
+    profiles["trendChange"] = recent.reindex(profiles.index, fill_value=0.0) - prior.reindex(profiles.index, fill_value=0.0)
+
+    by_state = profiles.groupby(level="state")
+    profiles["score"] = (100 * (
+        LEAD_SCORE_WEIGHTS["funding"] * by_state["totalFunding"].rank(pct=True)
+        + LEAD_SCORE_WEIGHTS["programs"] * profiles["programs"] / len(names)
+        + LEAD_SCORE_WEIGHTS["trend"] * by_state["trendChange"].rank(pct=True)
+    )).round(1)
+    profiles["rank"] = profiles.groupby(level="state")["score"].rank(method="first", ascending=False).astype(int)
+    profiles = profiles.reset_index().drop(columns="lead")
+    return profiles.sort_values(["state", "rank"]).reset_index(drop=True)
+
+def save_lead_profiles():
+    # only datasets that say who the lead is and what it was paid can be rolled into a profile
+    names = [name for name, spec in fema_datasets.items() if "name_field" in spec and "amount_field" in spec and dataset_mtime(spec)]
+    if not names:
+        return
+    source_mtime = max(dataset_mtime(fema_datasets[name]) for name in names)
+    with _fema_db_lock, closing(fema_db_connect()) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS _synced (dataset TEXT PRIMARY KEY, source_mtime REAL)")
+        row = db.execute("SELECT source_mtime FROM _synced WHERE dataset = ?", (LEAD_PROFILES_TABLE,)).fetchone()
+        if row and row[0] >= source_mtime:
+            return
+        with span("profiles.build", datasets=",".join(names)) as attrs:
+            profiles = build_lead_profiles(names)
+            attrs["records"] = len(profiles)
+        columns = list(profiles.columns)
+        types = {column: "REAL" if profiles[column].dtype.kind == "f" else "INTEGER" if profiles[column].dtype.kind in "iu" else "TEXT" for column in columns}
+        db.execute("BEGIN")
+        try:
+            db.execute(f'DROP TABLE IF EXISTS "{LEAD_PROFILES_TABLE}"')
+            column_sql = ", ".join(f'"{column}" {types[column]}' for column in columns)
+            db.execute(f'CREATE TABLE "{LEAD_PROFILES_TABLE}" ({column_sql})')
+            db.executemany(f'INSERT INTO "{LEAD_PROFILES_TABLE}" VALUES ({", ".join("?" * len(columns))})', profiles.itertuples(index=False, name=None))
+            db.execute(f'CREATE INDEX "{LEAD_PROFILES_TABLE}_state_idx" ON "{LEAD_PROFILES_TABLE}" ("state", "score")')
+            db.execute("INSERT OR REPLACE INTO _synced VALUES (?, ?)", (LEAD_PROFILES_TABLE, source_mtime))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    print(f"Saved {len(profiles)} cross-program lead profiles to '{FEMA_DB_PATH}'")
+
+def load_datasets(names=None, max_records=FEMA_MAX_RECORDS):
+    # max_records is per shard. every shard of every dataset syncs side by side; the per-host limit in fema_get
+    # keeps the combined page fan-out bounded, so adding states costs connections rather than wall time
+    names = list(fema_datasets) if names is None else names
+    with trace("datasets.load", datasets=",".join(names)):
+        return load_dataset_shards(names, max_records)
+
+def load_dataset_shards(names, max_records=FEMA_MAX_RECORDS):
+    jobs = [(fema_datasets[name], shard) for name in names for shard in dataset_shards(fema_datasets[name])]
+    with ThreadPoolExecutor(max_workers=max(min(len(jobs), FEMA_SHARD_WORKERS), 1), thread_name_prefix="shard") as shard_pool:
+        counts = list(shard_pool.map(carry_context(lambda job: sync_shard(*job, max_records)), jobs))
+    save_columnar_shards(jobs)
+    # then merged: one query index table and one lead table per dataset, built over all of its shards
+    totals = {}
+    for name in names:
+        spec = fema_datasets[name]
+        totals[name] = sum(count or 0 for (job_spec, _), count in zip(jobs, counts) if job_spec is spec)
+        incomplete = incomplete_shards(spec)
+        if incomplete:
+            print(f"{name} is incomplete: {len(incomplete)} shard(s) didn't finish and will resume on the next sync.")
+        try:
+            save_query_index(name)
+            if "leads_path" in spec:
+                save_lead_table(name)
+        except Exception as e:
+            print(f"Error occurred loading {name}: {e}")
+    try:
+        save_lead_profiles()
+    except Exception as e:
+        print(f"Error occurred building lead profiles: {e}")
+    return totals
+
+def load_dataset(name, max_records=FEMA_MAX_RECORDS):
+    return load_datasets([name], max_records)[name]
+
+# lazy startup
+# the dataset sync and the agency build (which is where every files_folder gets uploaded) each start at most once,
+# in the background, the first time something asks for them. the UI comes up straight away and the first query waits
+# only on what it needs
+_startup_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="startup")
+# agency builds wait on the dataset sync (the analysts need the lead tables), so they get workers of their own and can
+# never hold the ones the sync is queued for
+_agency_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agency")
+_startup_lock = threading.Lock()
+_startup = {}
+
+def start_once(key, fn, pool=_startup_pool):
+    with _startup_lock:
+        if key not in _startup:
+            _startup[key] = pool.submit(fn)
+        return _startup[key]
+
+def dataset_sync():
+    return start_once("datasets", load_datasets)
+
+def agency_startup():
+    return start_once("agency", startup_agency, _agency_pool)
+
+def startup_agency():
+    agency = create_agency()
+    # the first full build covers every folder, so whatever's left unreferenced in the file store can go. the session
+    # builds after it upload nothing new, so there's no need to check again
+    _startup_pool.submit(carry_context(prune_uploads))
+    return agency
+
+def claim_agency():
+    # every chat session gets an agency of its own (its own threads), see launch_ui. this hands out the one built
+    # ahead and starts building the next, so a new session rarely waits on a build
+    with _startup_lock:
+        ready = _startup.get("agency") or _agency_pool.submit(carry_context(startup_agency))
+        _startup["agency"] = _agency_pool.submit(carry_context(create_agency))
+    return ready.result()
+
+_lead_cache = {}
+
+def read_lead_table(name):
+    # keeps the parsed lead table around until the file on disk changes. None when there isn't one yet (failed sync)
+    copies = lead_table_copies(fema_datasets[name]["leads_path"])
+    if not copies:
+        return None
+    leads_path = max(copies, key=os.path.getmtime)
+    mtime = os.path.getmtime(leads_path)
+    cached = _lead_cache.get(name)
+    if cached is None or cached[:2] != (leads_path, mtime):
+        cached = (leads_path, mtime, pd.read_json(leads_path, orient='records'))
+        _lead_cache[name] = cached
+    return cached[2]
+
+class LeadLookup(BaseTool):
+    """
+    Looks up the pre-ranked openFEMA lead table for a dataset: leads ranked by total obligated funding per state,
+    with their record count and (for PA and HMA) the disaster with the largest obligation. Use this instead of
+    searching the raw data whenever you need the top leads or the numbers behind a specific lead.
+    """
+    dataset: Literal[tuple(fema_datasets)] = Field(..., description="Dataset from the registry: cayg for Public Assistance, hma for Hazard Mitigation Assistance, preparedness for EMPG.")
+    state: Optional[str] = Field(None, description="State to filter on, as it appears in the dataset (e.g. 'CA' for cayg, 'California' for hma and preparedness).")
+    name_contains: Optional[str] = Field(None, description="Case-insensitive part of the applicant, recipient or agency name to match.")
+    top: int = Field(10, description="How many leads to return, highest obligation first.")
+
+    def run(self):
+        dataset_sync().result()
+        spec = fema_datasets[self.dataset]
+        if "leads_path" not in spec:
+            return f"The {self.dataset} dataset has no lead table, use FemaQuery instead."
+        table = read_lead_table(self.dataset)
+        if table is None:
+            return "No matching leads."
+        if self.state:
+            table = table[table[spec.get("state_field", "state")].str.lower() == self.state.lower()]
+        if self.name_contains:
+            table = table[table[spec["name_field"]].str.contains(self.name_contains, case=False, regex=False, na=False)]
+        table = table.sort_values("totalObligated", ascending=False).head(self.top)
+        if table.empty:
+            return "No matching leads."
+        return table.to_json(orient='records')
+
+class LeadProfile(BaseTool):
+    """
+    Returns the cross-program funding picture for a lead, combining Public Assistance (cayg), Hazard Mitigation (hma) and
+    EMPG (preparedness) under one profile even when each dataset spells the name differently: total and per-program
+    funding, record counts, the yearly funding trend, the names it goes by in each dataset and a composite lead score
+    (0-100, higher is a better lead). Give a name to look a lead up, or just a state for its best scored leads.
+    """
+    name: Optional[str] = Field(None, description="Applicant, recipient or agency name, in any spelling (e.g. 'City of Tulsa' or 'TULSA, CITY OF').")
+    state: Optional[str] = Field(None, description="State as a postal code or full name (e.g. 'OK' or 'Oklahoma').")
+    top: int = Field(5, description="How many profiles to return, best score first.")
+
+    def run(self):
+        dataset_sync().result()
+        where, params = [], []
+        if self.state:
+            if state_code(self.state) is None:
+                return f"Unknown state '{self.state}'."
+            where.append('"state" = ?')
+            params.append(state_code(self.state))
+        # search holds a lead's name keys as "key | key". the whole key is tried first, then every token as a whole
+        # word, so "district 1" never turns up "district 11"
+        key = name_key(self.name or "")
+        attempts = [([], [])]
+        if key:
+            attempts = [
+                (['\'| \' || "search" || \' |\' LIKE ?'], [f"%| {key} |%"]),
+                (['\' \' || "search" || \' \' LIKE ?'] * len(key.split()), [f"% {token} %" for token in key.split()]),
+            ]
+        rows = []
+        with closing(sqlite3.connect(FEMA_DB_PATH, timeout=30)) as db:
+            db.execute("PRAGMA query_only = ON")
+            for name_where, name_params in attempts:
+                where_sql = f"WHERE {' AND '.join(where + name_where)}" if where + name_where else ""
+                try:
+                    cursor = db.execute(f'SELECT * FROM "{LEAD_PROFILES_TABLE}" {where_sql} ORDER BY "score" DESC LIMIT ?',
+                                        params + name_params + [max(1, min(self.top, FEMA_QUERY_MAX_ROWS))])
+                except sqlite3.OperationalError:
+                    return "Lead profiles haven't been built yet."
+                columns = [column[0] for column in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+                if rows:
+                    break
+        if not rows:
+            return "No matching leads."
+        for row in rows:
+            row.pop("search")
+            row["aliases"], row["trend"] = json.loads(row["aliases"]), json.loads(row["trend"])
+        return json.dumps(rows)
+
+FEMA_QUERY_MAX_ROWS = 200
+
+def like_contains(text):
+    # a LIKE pattern (with ESCAPE '\') matching text anywhere, its own % and _ taken literally
+    return "%" + re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
+class FemaQuery(BaseTool):
+    """
+    Runs a filter / sort / aggregate query over the locally indexed openFEMA data and returns only the matching rows.
+    Use it for numeric questions such as "top 10 recipients by obligation in FY2022" or "every project under disaster 4407".
+    Set group_by_name to total the amounts per lead instead of listing individual records.
+    """
+    dataset: Literal[tuple(fema_datasets)] = Field(..., description="Dataset from the registry: cayg for Public Assistance, hma for Hazard Mitigation Assistance, preparedness for EMPG.")
+    state: Optional[str] = Field(None, description="State as a postal code or full name (e.g. 'CA' or 'California').")
+    disaster_number: Optional[int] = Field(None, description="FEMA disaster number to filter on (cayg and hma only).")
+    name: Optional[str] = Field(None, description="Exact applicant, recipient or agency name (case-insensitive).")
+    name_contains: Optional[str] = Field(None, description="Part of the applicant, recipient or agency name to match.")
+    fiscal_year: Optional[int] = Field(None, description="Program fiscal year to filter on (hma only).")
+    group_by_name: bool = Field(False, description="Total the amounts per lead instead of returning individual records.")
+    sort: Literal["amount_desc", "amount_asc"] = Field("amount_desc", description="Sort order on the dollar amount.")
+    limit: int = Field(10, description=f"Maximum number of rows to return (at most {FEMA_QUERY_MAX_ROWS}).")
+
+    def run(self):
+        dataset_sync().result()
+        spec = fema_datasets[self.dataset]
+        if "name_field" not in spec or "amount_field" not in spec:
+            return f"The {self.dataset} dataset has no lead name or amount to query on."
+        state_field, name_field, amount_field = spec.get("state_field", "state"), spec["name_field"], spec["amount_field"]
+        where, params = [], []
+        if self.state:
+            code = state_code(self.state)
+            if code is None:
+                return f"Unknown state '{self.state}'."
+            where.append(f'"{state_field}" = ? COLLATE NOCASE')
+            params.append(US_STATES[code] if spec.get("state_format") == "name" else code)
+        if self.disaster_number is not None:
+            if not spec.get("disaster_field"):
+                return f"The {self.dataset} dataset has no disaster number."
+            where.append(f'"{spec["disaster_field"]}" = ?')
+            params.append(self.disaster_number)
+        if self.fiscal_year is not None:
+            if not spec.get("fiscal_year_field"):
+                return f"The {self.dataset} dataset has no fiscal year."
+            where.append(f'"{spec["fiscal_year_field"]}" = ?')
+            params.append(self.fiscal_year)
+        if self.name:
+            where.append(f'"{name_field}" = ? COLLATE NOCASE')
+            params.append(self.name)
+        if self.name_contains:
+            where.append(f'"{name_field}" LIKE ? ESCAPE \'\\\'')
+            params.append(like_contains(self.name_contains))
+        where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+        direction = "DESC" if self.sort == "amount_desc" else "ASC"
+        if self.group_by_name:
+            sql = (f'SELECT "{state_field}", "{name_field}", ROUND(SUM("{amount_field}"), 2) AS total, COUNT(*) AS records '
+                   f'FROM "{self.dataset}" {where_sql} GROUP BY 1, 2 ORDER BY total {direction} LIMIT ?')
         else:
-            print(f"Failed to fetch data. Status code: {response.status_code}")
-            break
-    return {'EmergencyManagementPerformanceGrants': all_data}
-
-# Existing parse_data function
-def preparedness_parse_data(data):
-    print("Parsing data.")
-    relevant_data = data['EmergencyManagementPerformanceGrants']
-    df = pd.DataFrame(relevant_data)
-    return df
-
-preparedness_selected_fields = ["state", "legalAgencyName", "projectEndDate", "fundingAmount"]
-preparedness_states_of_interest = ['California']
-
-preparedness_query_url = preparedness_build_query(
-    base_url="https://www.fema.gov/api/open",
-    version="v2",
-    entity="EmergencyManagementPerformanceGrants",
-    select=preparedness_selected_fields,
-    top=100,
-    states=preparedness_states_of_interest
-)
+            fields = ", ".join(f'"{field}"' for field in spec["select"] if field not in ("id", "lastRefresh"))
+            sql = f'SELECT {fields} FROM "{self.dataset}" {where_sql} ORDER BY "{amount_field}" {direction} LIMIT ?'
+        params.append(max(1, min(self.limit, FEMA_QUERY_MAX_ROWS)))
+        # no index file (the sync failed or hasn't got that far) or no table for the dataset in it yet
+        if not os.path.exists(FEMA_DB_PATH):
+            return f"The {self.dataset} dataset hasn't been indexed yet."
+        with closing(sqlite3.connect(FEMA_DB_PATH, timeout=30)) as db:
+            db.execute("PRAGMA query_only = ON")
+            try:
+                cursor = db.execute(sql, params)
+            except sqlite3.OperationalError:
+                return f"The {self.dataset} dataset hasn't been indexed yet."
+            columns = [column[0] for column in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        if not rows:
+            return "No matching records."
+        return json.dumps(rows)
 
-def preparedness_save_json(data, file_path):
-    with open(file_path, 'w') as json_file:
-        json.dump(data, json_file)
-    print(f"Data saved to '{file_path}'")
+# deal scoring
+# the deal calculator's weighted sum, worked out here instead of by the model with a code interpreter.
+# weights are per question, in the order scope alignment, contract value, internal matches, quals check, deal overview
+DEAL_WEIGHTS = {
+    "local": (.12, .15, .38, .12, .23),
+    "state": (.13, .2, .32, .15, .2),
+    "federal": (.13, .2, .32, .15, .2),
+}
 
-try:
-    preparedness_json_file_path = 'c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/preparedness/processed_preparedness_data.json'
-    if not os.path.exists(preparedness_json_file_path):
-        raw_data = preparedness_call_api(preparedness_query_url)
-        processed_data = preparedness_parse_data(raw_data)
-        processed_data_dict = processed_data.to_dict(orient='records')
-        preparedness_save_json(processed_data_dict, preparedness_json_file_path)
-    else:
-        print(f"JSON file already exists at '{preparedness_json_file_path}'. Skipping file creation.")
-except Exception as e:
-    print(f"Error occurred: {e}")
+def deal_verdict(percentage):
+    if percentage >= 80:
+        return "send it"
+    if percentage >= 70:
+        return "proceed with caution"
+    return "probably shouldn't bid unless there is a good reason"
+
+def score_deal(scores, jurisdiction):
+    # each score is 0-5, so weight * score summed and divided by 5 is the share of a perfect deal
+    weights = DEAL_WEIGHTS[jurisdiction]
+    if len(scores) != len(weights):
+        raise ValueError(f"Expected {len(weights)} scores, got {len(scores)}")
+    if any(not 0 <= score <= 5 for score in scores):
+        raise ValueError("Scores must be between 0 and 5")
+    percentage = round(sum(weight * score for weight, score in zip(weights, scores)) / 5 * 100, 1)
+    return {"percentage": percentage, "verdict": deal_verdict(percentage)}
+
+def score_deals(deals):
+    # deals: iterable of (scores, jurisdiction)
+    return [score_deal(scores, jurisdiction) for scores, jurisdiction in deals]
+
+class RfpScores(BaseModel):
+    rfp: str = Field(..., description="Name or identifier of the RFP.")
+    jurisdiction: Literal["local", "state", "federal"] = Field(..., description="Level of government issuing the RFP.")
+    scope_alignment: int = Field(..., ge=0, le=5, description="Score from the Strategy Analysis and Alignment agent.")
+    contract_value: int = Field(..., ge=0, le=5, description="Score from the Contract Value Evaluator.")
+    internal_matches: int = Field(..., ge=0, le=5, description="Score from the Internal Staff Alignment agent.")
+    quals_check: int = Field(..., ge=0, le=5, description="Score from the Qual Checker.")
+    deal_overview: int = Field(..., ge=0, le=5, description="Score from the Deal Overview agent.")
+
+class DealScore(BaseTool):
+    """
+    Turns the five evaluator scores for one or more RFPs into the weighted deal percentage and the bid verdict
+    (80%+ send it, 70-80% proceed with caution, below 70% probably shouldn't bid). Pass every RFP you need scored in one call.
+    """
+    rfps: List[RfpScores] = Field(..., description="One entry per RFP with its jurisdiction and the five scores.")
+
+    def run(self):
+        results = score_deals(
+            ((rfp.scope_alignment, rfp.contract_value, rfp.internal_matches, rfp.quals_check, rfp.deal_overview), rfp.jurisdiction)
+            for rfp in self.rfps
+        )
+        return json.dumps([{"rfp": rfp.rfp, **result} for rfp, result in zip(self.rfps, results)])
+
+class EvaluateDeal(BaseTool):
+    """
+    Scores one RFP end to end. Asks the Strategy Analysis and Alignment, Contract Value Evaluator, Internal Staff Alignment
+    and Qual Checker agents at the same time, hands their findings to the Deal Overview agent, then weights the five
+    scores into the deal percentage and verdict. Returns every evaluator's answer and score, and lists any that didn't
+    answer in time so you can follow up with them yourself.
+    """
+    rfp: str = Field(..., description="The RFP to evaluate: its name plus whatever you know about scope, value, location and requirements.")
+    jurisdiction: Literal["local", "state", "federal"] = Field(..., description="Level of government issuing the RFP.")
+
+    def run(self):
+        agency = _agent_agencies.get(id(self.caller_agent))
+        if agency is None:
+            return "Error: EvaluateDeal can only run inside the agency, message the evaluators directly instead."
+        return json.dumps(evaluate_deal(agency, self.caller_agent.name, self.rfp, self.jurisdiction))
+
+# pipeline store
+# opportunities live in sqlite instead of json files the pipeline manager rewrote on every change. one row per
+# (lead, state, product), indexed on lead, state, stage and product; UpsertOpportunity changes a row in one transaction
+# (so concurrent sessions can't clobber each other) and QueryPipeline reads only the rows it needs. lead names are matched
+# on the same normalised key as the lead profiles. every change bumps a sequence number, and export_pipeline appends
+# only the rows changed since the last export to a json-lines file (last line per id wins), outside the agents' folders
+PIPELINE_DB_PATH = f"{SALESDOCS_DIR}/.pipeline.sqlite"
+PIPELINE_EXPORT_PATH = f"{SALESDOCS_DIR}/exports/pipeline.jsonl"
+PIPELINE_STAGES = ["identified", "qualified", "proposal", "negotiation", "won", "lost"]
+PIPELINE_MAX_ROWS = 200
+PIPELINE_FIELDS = ["id", "lead", "state", "product", "stage", "value", "owner", "next_step", "notes", "created_at", "updated_at"]
+
+def pipeline_connect():
+    os.makedirs(os.path.dirname(PIPELINE_DB_PATH), exist_ok=True)
+    db = sqlite3.connect(PIPELINE_DB_PATH, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("""CREATE TABLE IF NOT EXISTS opportunities (
+        id INTEGER PRIMARY KEY, lead TEXT NOT NULL, lead_key TEXT NOT NULL, state TEXT NOT NULL, product TEXT NOT NULL COLLATE NOCASE,
+        stage TEXT, value REAL, owner TEXT, next_step TEXT, notes TEXT, created_at REAL, updated_at REAL, seq INTEGER,
+        UNIQUE (lead_key, state, product))""")
+    db.execute("CREATE INDEX IF NOT EXISTS opportunities_state_idx ON opportunities (state, stage)")
+    db.execute("CREATE INDEX IF NOT EXISTS opportunities_stage_idx ON opportunities (stage)")
+    db.execute("CREATE INDEX IF NOT EXISTS opportunities_product_idx ON opportunities (product)")
+    db.execute("CREATE INDEX IF NOT EXISTS opportunities_seq_idx ON opportunities (seq)")
+    db.execute("CREATE TABLE IF NOT EXISTS _exports (path TEXT PRIMARY KEY, seq INTEGER)")
+    return db
+
+def pipeline_rows(cursor):
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def upsert_opportunity(lead, state, product, stage=None, value=None, owner=None, next_step=None, notes=None):
+    # fields left as None keep what's stored; notes are appended, not replaced
+    now = time.time()
+    with closing(pipeline_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            seq = db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM opportunities").fetchone()[0]
+            db.execute("""INSERT INTO opportunities (lead, lead_key, state, product, stage, value, owner, next_step, notes, created_at, updated_at, seq)
+                VALUES (?, ?, ?, ?, COALESCE(?, ?), ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (lead_key, state, product) DO UPDATE SET
+                    lead = excluded.lead,
+                    stage = COALESCE(?, stage),
+                    value = COALESCE(excluded.value, value),
+                    owner = COALESCE(excluded.owner, owner),
+                    next_step = COALESCE(excluded.next_step, next_step),
+                    notes = CASE WHEN excluded.notes IS NULL THEN notes WHEN notes IS NULL THEN excluded.notes ELSE notes || char(10) || excluded.notes END,
+                    updated_at = excluded.updated_at,
+                    seq = excluded.seq""",
+                (lead, name_key(lead), state, product, stage, PIPELINE_STAGES[0], value, owner, next_step, notes, now, now, seq, stage))
+            row = pipeline_rows(db.execute(f"SELECT {', '.join(PIPELINE_FIELDS)} FROM opportunities WHERE seq = ?", (seq,)))[0]
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return row
+
+def query_pipeline(lead=None, state=None, stage=None, product=None, limit=50):
+    where, params = [], []
+    for field, value in (("state", state), ("stage", stage), ("product", product)):
+        if value:
+            where.append(f"{field} = ?")
+            params.append(value)
+    # the exact lead key first (that's the indexed lookup), then every token as a whole word, so "lead 1" never
+    # turns up "lead 91"
+    key = name_key(lead or "")
+    attempts = [([], [])]
+    if key:
+        attempts = [(["lead_key = ?"], [key]), (["' ' || lead_key || ' ' LIKE ?"] * len(key.split()), [f"% {token} %" for token in key.split()])]
+    with closing(pipeline_connect()) as db:
+        for lead_where, lead_params in attempts:
+            where_sql = f"WHERE {' AND '.join(lead_where + where)}" if lead_where + where else ""
+            rows = pipeline_rows(db.execute(f"SELECT {', '.join(PIPELINE_FIELDS)} FROM opportunities {where_sql} ORDER BY updated_at DESC LIMIT ?",
+                                            lead_params + params + [max(1, min(limit, PIPELINE_MAX_ROWS))]))
+            if rows:
+                break
+    return rows
+
+def pipeline_summary(state=None, product=None):
+    where = " AND ".join(f"{field} = ?" for field, value in (("state", state), ("product", product)) if value)
+    params = [value for value in (state, product) if value]
+    with closing(pipeline_connect()) as db:
+        return pipeline_rows(db.execute(
+            f"SELECT stage, COUNT(*) AS opportunities, ROUND(SUM(value), 2) AS total_value FROM opportunities {'WHERE ' + where if where else ''} GROUP BY stage", params))
+
+def export_pipeline(export_path=PIPELINE_EXPORT_PATH):
+    # appends the rows changed since the last export. the write lock is held throughout, so two exports never interleave
+    os.makedirs(os.path.dirname(export_path), exist_ok=True)
+    with closing(pipeline_connect()) as db:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT seq FROM _exports WHERE path = ?", (export_path,)).fetchone()
+            if not os.path.exists(export_path):
+                row = None
+            changed = pipeline_rows(db.execute(f"SELECT {', '.join(PIPELINE_FIELDS)}, seq FROM opportunities WHERE seq > ? ORDER BY seq", (row[0] if row else 0,)))
+            if changed:
+                with open(export_path, 'a') as export_file:
+                    export_file.writelines(json.dumps(opportunity) + "\n" for opportunity in changed)
+                db.execute("INSERT OR REPLACE INTO _exports VALUES (?, ?)", (export_path, changed[-1]["seq"]))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    return len(changed)
+
+class UpsertOpportunity(BaseTool):
+    """
+    Adds an opportunity to the sales pipeline or updates the one already there for the same lead, state and product.
+    Only the fields you give are changed; notes are appended to the existing notes. Returns the stored opportunity.
+    """
+    lead: str = Field(..., description="Lead (applicant, recipient or agency) name.")
+    state: str = Field(..., description="State as a postal code or full name (e.g. 'OK' or 'Oklahoma').")
+    product: str = Field(..., description="Product or service the opportunity is for, e.g. 'CAYG', 'HMA' or 'Preparedness'.")
+    stage: Optional[Literal[tuple(PIPELINE_STAGES)]] = Field(None, description="Pipeline stage. New opportunities start at 'identified'.")
+    value: Optional[float] = Field(None, description="Estimated contract value in dollars.")
+    owner: Optional[str] = Field(None, description="Who on the team owns the opportunity.")
+    next_step: Optional[str] = Field(None, description="The next action to take.")
+    notes: Optional[str] = Field(None, description="Anything worth recording, appended to earlier notes.")
+
+    def run(self):
+        state = state_code(self.state)
+        if state is None:
+            return f"Unknown state '{self.state}'."
+        row = upsert_opportunity(self.lead, state, self.product, self.stage, self.value, self.owner, self.next_step, self.notes)
+        export_pipeline()
+        return json.dumps(row)
+
+class QueryPipeline(BaseTool):
+    """
+    Looks up opportunities in the sales pipeline by lead name (any spelling), state, stage or product, most recently
+    updated first. Set summary to get the number of opportunities and total value per stage instead.
+    """
+    lead: Optional[str] = Field(None, description="Lead name or part of it.")
+    state: Optional[str] = Field(None, description="State as a postal code or full name.")
+    stage: Optional[Literal[tuple(PIPELINE_STAGES)]] = Field(None, description="Pipeline stage to filter on.")
+    product: Optional[str] = Field(None, description="Product or service to filter on, e.g. 'CAYG'.")
+    summary: bool = Field(False, description="Return counts and total value per stage instead of individual opportunities.")
+    limit: int = Field(20, description=f"Maximum number of opportunities to return (at most {PIPELINE_MAX_ROWS}).")
+
+    def run(self):
+        state = None
+        if self.state:
+            state = state_code(self.state)
+            if state is None:
+                return f"Unknown state '{self.state}'."
+        if self.summary:
+            rows = pipeline_summary(state, self.product)
+        else:
+            rows = query_pipeline(self.lead, state, self.stage, self.product, self.limit)
+        if not rows:
+            return "No matching opportunities."
+        return json.dumps(rows)
+
+# agents are described up front but only built when the agency is, since building one uploads its files_folder
+def agent_spec(**kwargs):
+    return kwargs
 
 #idea for top agents
-agency_coordinator = Agent(
+agency_coordinator = agent_spec(
     name="Agency Coordinator",
     description="Communicates with the user to both facilitate conversation and utilize the agency to build sales intelligence and help with opportunity management.",
     instructions='''
@@ -268,6 +1879,7 @@ agency_coordinator = Agent(
         1.) Close As You Go Analyst
         2.) Hazard Mitigation Analyst
         3.) Preparedness Analyst
+    - For a lead's whole federal funding picture across PA, HMA and EMPG (or the best scored leads in a state), use the LeadProfile tool first; it answers in one lookup what would otherwise take all three analysts
     - Craft a robust strategy for pursuing a lead while highlight both how the product or service can be of use and any sales tips
     - Work with the outreach team to create tailored outreach messages and templates for communications
     - Build out or edit leads and current work in the pipeline through the pipeline management agent
@@ -277,40 +1889,43 @@ agency_coordinator = Agent(
     
     There is no particular order with which the coordinator should work but rather leverage any of the agents at any point to help the user with whatever query they have    
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/strategy",
-    tools=[Retrieval] #I could use an entire breakdown of services here...
+    files_folder=f"{SALESDOCS_DIR}/strategy",
+    tools=[Retrieval, LeadProfile] #I could use an entire breakdown of services here...
 )
 
 # AI Agents with Adjusted Roles and Capabilities
-cayg_analyst = Agent(
+cayg_analyst = agent_spec(
     name="CAYG Analyst",
     description="Focused on helping provide data-driven insights to help sell Close As You Go (CAYG) to those in need of a grants management software as a service.",
     instructions='''
-    - Conduct an in-depth analysis of openFEMA datasets to identify leads, focusing on the highest amounts of federalShareObligated. 
+    - Identify leads from the openFEMA data, focusing on the highest amounts of federalShareObligated. Use the LeadLookup tool with dataset "cayg" for rankings and lead details; it returns leads already ranked by total obligation per state.
+    - For anything more specific (a disaster number, an exact applicant, raw records behind a lead, custom totals) use the FemaQuery tool with dataset "cayg" rather than searching files.
     - Based on how the user asks about leads (specific or broad), adjust the returns by either providing either a singular lead's details or a small list of leads (always be succinct yet comprehensive while including key data points). 
     - Utilize the insights gained paired with Close As You Go knowledge to help return information to the coordinator.
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/cayg",
-    tools=[Retrieval]
+    files_folder=f"{SALESDOCS_DIR}/cayg",
+    tools=[Retrieval, LeadLookup, FemaQuery]
 )
 
-hma_analyst = Agent(
+hma_analyst = agent_spec(
     name="Hazard Mitigation Assistance Analyst",
     description="Focused on helping provide data-driven insights to help sell Hazard Mitigation Assistance Services to those in need of a grants management software as a service.",
     instructions='''
-    - Conduct an in-depth analysis of openFEMA datasets to identify leads, focusing on the highest amounts of federalShareObligated. 
+    - Identify leads from the openFEMA data, focusing on the highest amounts of federalShareObligated. Use the LeadLookup tool with dataset "hma" for rankings and lead details; it returns leads already ranked by total obligation per state.
+    - For anything more specific (a disaster number, a fiscal year, an exact applicant, raw records behind a lead, custom totals) use the FemaQuery tool with dataset "hma" rather than searching files.
     - Based on how the user asks about leads (specific or broad), adjust the returns by either providing either a singular lead's details or a small list of leads (always be succinct yet comprehensive while including key data points). 
     - Utilize the insights gained paired with Hazard Mitigation Services knowledge to help return information to the coordinator.
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/hma",
-    tools=[Retrieval]
+    files_folder=f"{SALESDOCS_DIR}/hma",
+    tools=[Retrieval, LeadLookup, FemaQuery]
 )
 
-preparedness_analyst = Agent(
+preparedness_analyst = agent_spec(
     name="Emergency Management Preparedness Analyst",
     description="Focused on helping provide data-driven insights to help sell Emergency Management Preparedness Grant Services to those in need of a grants management software as a service.",
     instructions='''
-    - Conduct an in-depth analysis of openFEMA datasets to identify leads, focusing on the highest amounts of projectAmount. 
+    - Identify leads from the openFEMA data, focusing on the highest amounts of fundingAmount. Use the LeadLookup tool with dataset "preparedness" for rankings and lead details; it returns leads already ranked by total funding per state.
+    - For anything more specific (a disaster number, an exact applicant, raw records behind a lead, custom totals) use the FemaQuery tool with dataset "preparedness" rather than searching files.
     - Based on how the user asks about leads (specific or broad), adjust the returns by either providing either a singular lead's details or a small list of leads (always be succinct yet comprehensive while including key data points). 
     - Utilize the insights gained paired with Hazard Mitigation Services knowledge to help return information to the coordinator.
         - The EMPG is to support a comprehensive, all-hazard emergency preparedness system by building and sustaining the core capabilities contained in the NPG's. Examples include:
@@ -322,12 +1937,12 @@ preparedness_analyst = Agent(
             - Initiating or achieving a whole community approach to security and emergency management.
             - Strengthening cybersecurity measures.
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/preparedness",
-    tools=[Retrieval]
+    files_folder=f"{SALESDOCS_DIR}/preparedness",
+    tools=[Retrieval, LeadLookup, FemaQuery]
 )
 
 #Agnogstic Team
-outreach_engagement = Agent(
+outreach_engagement = agent_spec(
     name="Outreach and Engagement Specialist",
     description="Works with identified leads to highlight the strategy for selling the either the product, the service, or both.",
     instructions='''
@@ -339,7 +1954,7 @@ outreach_engagement = Agent(
     tools=None
 )
 
-pipeline_manager = Agent( #this bloke really needs some help
+pipeline_manager = agent_spec( #this bloke really needs some help
     name="Pipeline Manager",
     description="Helps take an identified lead and vet if it aligns with any of the clients in the pipeline.",
     instructions='''
@@ -347,35 +1962,36 @@ pipeline_manager = Agent( #this bloke really needs some help
     - For each lead, cross-reference with existing pipeline data to identify any connections or opportunities.
     - If a match is found, gather relevant details and inform the stakeholder about the lead's position and potential next steps in the pipeline.
     - In cases where no immediate match is found, propose strategies for expanding the pipeline or leveraging other resources to accommodate the new lead.
-    - Upon confirming a lead's relevance, coordinate with the data management agent to update the pipeline records. This includes modifying the existing data or adding new information using the `json.dumps` method, ensuring all updates are saved to the designated file in the specified directory.
+    - Use the QueryPipeline tool to check whether a lead is already in the pipeline and where it stands (it matches lead names in any spelling), and its summary option for the state of the pipeline as a whole.
+    - Upon confirming a lead's relevance, record it with the UpsertOpportunity tool: one call adds the opportunity or updates the existing one for that lead, state and product. Only pass the fields that changed, and put anything worth remembering in notes.
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/pipeline",
-    tools=[Retrieval]
+    files_folder=f"{SALESDOCS_DIR}/pipeline",
+    tools=[Retrieval, QueryPipeline, UpsertOpportunity]
 )
 
-contact_identifier = Agent(
+contact_identifier = agent_spec(
     name="Contact Identifier",
     description="Identifies contacts to reach out to when pursuing a lead.",
     instructions='''
     - When the user is requesting a potential lead's point of contact, utilize your training set to provide either offering a state official or an internal contact.
     - As a last resort, you should provide step-by-step instructions to find contacts, specifically looking for the head of community development.
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/contact_information",
+    files_folder=f"{SALESDOCS_DIR}/contact_information",
     tools=[Retrieval]
 )
 
-rfp_identifier = Agent(
+rfp_identifier = agent_spec(
     name="Request for Proposal Identifier",
     description="Identifies a potential RFP that is relevant to what the identified lead needs and what the relevant product or service provides.",
     instructions='''
     - When the user is requesting to learn more about what RFPs may be associated to the identified lead, either provide RFPs or how to access them by leveraging your training set.
     - As a last resort, you should provide step-by-step instructions so that so that the browsing agent knows how to efficiently browse and return data.
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/requests_for_proposal",
+    files_folder=f"{SALESDOCS_DIR}/requests_for_proposal",
     tools=[Retrieval]
 )
 
-deal_calculator = Agent(
+deal_calculator = agent_spec(
     name="Deal Calculator",
     description="This agent's responsibility is to intake an identified rfp and run it through a team of agents to determine if it is worthy of pursuit.",
     instructions='''
@@ -387,38 +2003,18 @@ deal_calculator = Agent(
     5. deal overview - work with the deal overview agent
 
     prompt the relevant agents to intake ALL scores from the agents. there should be 5 in total
-    to get the score, you multiple the weight of the answer by the % assigned to the question. 
-    you then add up the scores and then divde that by 5 (or if you take each of the % * 5 and add up it equals 5)
-    - < 69% probably shouldnt bid unless there is a good reason
-    - 70-80% proceed with caution
-    - 80%+ send it
-
-    Local weights per question
-        1. .12
-        2. .15
-        3. .38
-        4. .12
-        5. .23
-    State weights per question
-        1. .13
-        2. .2
-        3. .32
-        4. .15
-        5. .2
-    Federal weights per question
-        1. .13
-        2. .2
-        3. .32
-        4. .15
-        5. .2
-
-    You should be capable of utilizing your codeinterpreter tool to calculate the final score and based on findings, provide a report on the final verdict!
+    use the EvaluateDeal tool for this: it asks the agents for questions 1-4 at the same time, passes their findings to the
+    deal overview agent for question 5 and returns all 5 scores with the weighted percentage and verdict.
+    only message an agent yourself when EvaluateDeal says it timed out or gave no score, then use the DealScore tool
+    on the completed scores. both tools hold the weights and thresholds, so never work the math out yourself.
+    DealScore takes several rfps at once if you are asked to compare or triage more than one.
+    based on findings, provide a report on the final verdict!
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/rfp_bank",
-    tools=[CodeInterpreter, Retrieval] # put the RFP in here if its a go. the agency should be able to tell you i think based on search methods.
+    files_folder=f"{SALESDOCS_DIR}/rfp_bank",
+    tools=[EvaluateDeal, DealScore, Retrieval] # put the RFP in here if its a go. the agency should be able to tell you i think based on search methods.
 )
 
-deal_strategy = Agent(
+deal_strategy = agent_spec(
     name="Strategy Analysis and Alignment",
     description="This agent's responsibility is to intake the rfp's scope of work assign a score based on how well it aligns with the provided products and services.",
     instructions='''
@@ -428,11 +2024,11 @@ deal_strategy = Agent(
         missing strategy? (score=1)
         missing strategy, methodology, and training? (score=0)
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/strategy",
+    files_folder=f"{SALESDOCS_DIR}/strategy",
     tools=[Retrieval]
 )
 
-contract_evaluator = Agent(
+contract_evaluator = agent_spec(
     name="Contract Value Evaluator",
     description="This agent's responsibility is to work with the rfp_itentifier to place a value on the contract. Based on the value, assign a score.",
     instructions='''
@@ -446,7 +2042,7 @@ contract_evaluator = Agent(
     tools=[Retrieval]
 )
 
-internal_staff_allignment = Agent(
+internal_staff_allignment = agent_spec(
     name="Internal Staff Alignment",
     description="This agent's responsibility is to intake the needs for services and pair with the relevant staff and leadership. Based on the analysis, assign as score to gauge the ability to deliver.",
     instructions='''
@@ -456,11 +2052,11 @@ internal_staff_allignment = Agent(
         The state isn't a priority but we have some staff available and possibly a partner (score=1)
         The state is not a priority, we don't have the staff, and we don't have a partner (score=0)
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/internal_staff", # staffing docs for availability, delivery risk, partners
+    files_folder=f"{SALESDOCS_DIR}/internal_staff", # staffing docs for availability, delivery risk, partners
     tools=[Retrieval]
 )
 
-quals_agent = Agent(
+quals_agent = agent_spec(
     name="Qual Checker",
     description="This agent's responsibility is to intake information about the RFP's scope and try to match it with the qualifications stored in training set.",
     instructions='''
@@ -469,11 +2065,11 @@ quals_agent = Agent(
         some of the quals are there (score=3)
         the quals arent there (score=0)
     ''',
-    files_folder="c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/qualifications", # mock quals 
+    files_folder=f"{SALESDOCS_DIR}/qualifications", # mock quals 
     tools=[Retrieval]
 )
 
-overview_evaluation = Agent(
+overview_evaluation = agent_spec(
     name="Deal Overview",
     description="This agent's responsibility is to look at the overall scores gathered so far and assign one more score before final evaluation.",
     instructions='''
@@ -489,29 +2085,18 @@ overview_evaluation = Agent(
 # ideas...
 # we need to bridge the gap with Deloitte. current work, timelines, and contacts could be incredibly valuable as insights for end users
 
-browsing_agent = BrowsingAgent()
-browsing_agent.instructions = "\n\nPlease browse the web and execute actions based on the instructions given by the other agents. If you are getting stuck, please stop and return what you've gathered to the rfp identifier."
-
-coding_agent = CodingAgent()
-coding_agent.instructions += "\n\nExecute code as you are instructed to."
-
-# file cleanup
-def cleanup_json_files(directory):
-    for filename in os.listdir(directory):
-        if filename.endswith(".json"):  # Check if the file is a JSON file
-            file_path = os.path.join(directory, filename)
-            try:
-                os.remove(file_path)  # Delete the file
-                print(f"Deleted JSON file: {file_path}")
-            except Exception as e:
-                print(f"Failed to delete JSON file: {file_path}. Reason: {e}")
+# not part of the chart yet, so only built if someone asks for them
+@lru_cache(maxsize=None)
+def build_browsing_agent():
+    browsing_agent = BrowsingAgent()
+    browsing_agent.instructions = "\n\nPlease browse the web and execute actions based on the instructions given by the other agents. If you are getting stuck, please stop and return what you've gathered to the rfp identifier."
+    return browsing_agent
 
-directory_to_cleanup_cayg = "c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/cayg"
-directory_to_cleanup_hma = "c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/hma"
-directory_to_cleanup_preparedness = "c:/Users/Fcoon/Desktop/AI/Assistant/salesdocs/preparedness"
-atexit.register(cleanup_json_files, directory_to_cleanup_cayg)
-atexit.register(cleanup_json_files, directory_to_cleanup_hma)
-atexit.register(cleanup_json_files, directory_to_cleanup_preparedness)
+@lru_cache(maxsize=None)
+def build_coding_agent():
+    coding_agent = CodingAgent()
+    coding_agent.instructions += "\n\nExecute code as you are instructed to."
+    return coding_agent
 
 # Define Manifesto
 agency_manifesto = """
@@ -545,8 +2130,633 @@ agency_chart = [
     [deal_calculator, overview_evaluation]
 ]
 
-# Initialize your agents and agency outside of the main function
-agency = Agency(agency_chart, shared_instructions=agency_manifesto)
+# deal fan-out
+# the four evaluators that don't depend on each other are asked at once, each over its own deal calculator thread, and
+# their findings go to the deal overview afterwards. a branch that hasn't answered within DEAL_BRANCH_TIMEOUT seconds is
+# left out (its run gets cancelled) rather than holding up the score
+DEAL_BRANCH_TIMEOUT = 180
+DEAL_BRANCHES = [
+    ("scope_alignment", deal_strategy),
+    ("contract_value", contract_evaluator),
+    ("internal_matches", internal_staff_allignment),
+    ("quals_check", quals_agent),
+]
+DEAL_EVALUATOR_PROMPT = """Score this RFP for your question.
+
+RFP: {rfp}
+Jurisdiction: {jurisdiction}
+
+Explain your reasoning briefly and end your reply with a line of the form "SCORE: <0-5>"."""
+DEAL_OVERVIEW_PROMPT = """Here is what the other evaluators found for this RFP.
+
+RFP: {rfp}
+Jurisdiction: {jurisdiction}
+
+{findings}
+
+Give your deal overview score. End your reply with a line of the form "SCORE: <0-5>"."""
+
+# agency for each built agent, so tools can find the threads of the agency they were called in
+_agent_agencies = weakref.WeakValueDictionary()
+
+def thread_reply(thread, message):
+    # Thread.get_completion is a generator even with yield_messages off, the reply is its return value
+    completion = thread.get_completion(message=message, yield_messages=False)
+    if not inspect.isgenerator(completion):
+        return completion
+    try:
+        while True:
+            next(completion)
+    except StopIteration as e:
+        return e.value
+
+def cancel_thread_run(thread):
+    # a run left going would block the next message on that thread
+    run = getattr(thread, "run", None)
+    if run is not None and getattr(run, "status", None) in ("queued", "in_progress", "requires_action"):
+        try:
+            get_openai_client().beta.threads.runs.cancel(thread_id=thread.id, run_id=run.id)
+        except Exception as e:
+            print(f"Could not cancel the run on thread {thread.id}: {e}")
+
+def reply_score(reply):
+    # markdown is fine ("**SCORE:** 4"), a decimal ("SCORE: 4.5") isn't a score on the 0-5 scale
+    scores = re.findall(r"SCORE\s*\**\s*:\s*\**\s*([0-5])(?![\d.]\d|\d)", reply or "")
+    return int(scores[-1]) if scores else None
+
+def ask_branches(threads, messages, timeout=DEAL_BRANCH_TIMEOUT):
+    # threads / messages: {key: ...}. returns {key: reply} with None for branches that failed or ran out of time
+    branch_pool = ThreadPoolExecutor(max_workers=max(len(threads), 1), thread_name_prefix="deal-branch")
+
+    def ask(key):
+        with span("deal.branch", branch=key):
+            return thread_reply(threads[key], messages[key])
+
+    futures = {key: branch_pool.submit(carry_context(ask), key) for key in threads}
+    wait(futures.values(), timeout=timeout)
+    replies = {}
+    for key, future in futures.items():
+        if not future.done():
+            print(f"{key} didn't answer within {timeout}s, leaving it out.")
+            cancel_thread_run(threads[key])
+            replies[key] = None
+        elif future.exception() is not None:
+            print(f"{key} failed: {future.exception()}")
+            replies[key] = None
+        else:
+            replies[key] = future.result()
+    # stuck branches finish (or fail on the cancelled run) in the background
+    branch_pool.shutdown(wait=False, cancel_futures=True)
+    return replies
+
+def evaluate_deal(agency, calculator_name, rfp, jurisdiction, timeout=DEAL_BRANCH_TIMEOUT):
+    threads = agency.agents_and_threads[calculator_name]
+    message = DEAL_EVALUATOR_PROMPT.format(rfp=rfp, jurisdiction=jurisdiction)
+    branch_threads = {key: threads[spec["name"]] for key, spec in DEAL_BRANCHES}
+    answers = ask_branches(branch_threads, {key: message for key in branch_threads}, timeout)
+
+    findings = "\n\n".join(
+        f"{spec['name']} ({key}):\n{answers[key] if answers[key] is not None else 'no answer in time'}"
+        for key, spec in DEAL_BRANCHES
+    )
+    overview_message = DEAL_OVERVIEW_PROMPT.format(rfp=rfp, jurisdiction=jurisdiction, findings=findings)
+    answers.update(ask_branches({"deal_overview": threads[overview_evaluation["name"]]}, {"deal_overview": overview_message}, timeout))
+
+    scores = {key: reply_score(answer) for key, answer in answers.items()}
+    result = {
+        "rfp": rfp,
+        "jurisdiction": jurisdiction,
+        "scores": scores,
+        "answers": answers,
+        "missing": [key for key, score in scores.items() if score is None],
+    }
+    if not result["missing"]:
+        order = [key for key, _ in DEAL_BRANCHES] + ["deal_overview"]
+        result.update(score_deal([scores[key] for key in order], jurisdiction))
+    return result
+
+# file uploads
+# agents get file_ids instead of a files_folder, so agency_swarm never uploads (or renames) anything itself. every file is
+# hashed and looked up in a manifest of what's already in the openai file store: unchanged documents cost nothing, a
+# document shared between folders or agents goes up once, and new or edited ones upload side by side.
+# hashes are cached by path, mtime and size, so unchanged files aren't even re-read
+UPLOAD_MANIFEST_PATH = f"{SALESDOCS_DIR}/.upload_manifest.json"
+FILE_UPLOAD_WORKERS = 8
+
+_upload_pool = ThreadPoolExecutor(max_workers=FILE_UPLOAD_WORKERS, thread_name_prefix="upload")
+_upload_lock = threading.Lock()
+_uploads_in_flight = {}
+_upload_manifest = None
+# what this process changed since it last wrote the manifest, so the merge in save_upload_manifest knows whose is whose
+_upload_added = set()
+_upload_removed = set()
+_upload_dropped_paths = set()
+
+def upload_manifest():
+    # {"files": {sha256: {file_id, name, bytes, uploaded_at}}, "hashes": {path: {sha256, mtime_ns, size}}}
+    global _upload_manifest
+    with _upload_lock:
+        if _upload_manifest is None:
+            try:
+                with open(UPLOAD_MANIFEST_PATH) as manifest_file:
+                    _upload_manifest = json.load(manifest_file)
+            except (OSError, ValueError):
+                _upload_manifest = {"files": {}, "hashes": {}}
+        return _upload_manifest
+
+def save_upload_manifest():
+    # call with _upload_lock held. other processes (the UI and a --triage run, say) share the manifest, so it's re-read
+    # under a file lock and this process's uploads and removals are merged into theirs instead of overwriting them.
+    # that also picks up what they uploaded, so this process doesn't upload it again
+    os.makedirs(os.path.dirname(UPLOAD_MANIFEST_PATH), exist_ok=True)
+    with file_lock(UPLOAD_MANIFEST_PATH + ".lock"):
+        try:
+            with open(UPLOAD_MANIFEST_PATH) as manifest_file:
+                on_disk = json.load(manifest_file)
+        except (OSError, ValueError):
+            on_disk = {"files": {}, "hashes": {}}
+        files = {digest: entry for digest, entry in on_disk["files"].items() if digest not in _upload_removed}
+        files.update({digest: _upload_manifest["files"][digest] for digest in _upload_added if digest in _upload_manifest["files"]})
+        hashes = {**on_disk["hashes"], **_upload_manifest["hashes"]}
+        for path in _upload_dropped_paths:
+            hashes.pop(path, None)
+        _upload_manifest["files"], _upload_manifest["hashes"] = files, hashes
+        _atomic_write(UPLOAD_MANIFEST_PATH, json.dumps(_upload_manifest, indent=1))
+    _upload_added.clear()
+    _upload_removed.clear()
+    _upload_dropped_paths.clear()
+
+def file_sha256(path):
+    manifest = upload_manifest()
+    stat = os.stat(path)
+    cached = manifest["hashes"].get(path)
+    if cached and cached["mtime_ns"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+        return cached["sha256"]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    with _upload_lock:
+        manifest["hashes"][path] = {"sha256": digest.hexdigest(), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    return digest.hexdigest()
+
+def upload_file(path, digest):
+    # files agency_swarm renamed on an earlier upload go up under their original name
+    name = re.sub(r"_file-[A-Za-z0-9]+(?=\.[^.]*$|$)", "", os.path.basename(path))
+    try:
+        with span("file.upload", file=name, bytes=os.path.getsize(path)), open(path, 'rb') as f:
+            file_id = get_openai_client().files.create(file=(name, f), purpose="assistants").id
+        print(f"Uploaded {name} as {file_id}")
+        with _upload_lock:
+            _upload_manifest["files"][digest] = {"file_id": file_id, "name": name, "bytes": os.path.getsize(path), "uploaded_at": time.time()}
+            _upload_added.add(digest)
+            save_upload_manifest()
+        return file_id
+    finally:
+        with _upload_lock:
+            _uploads_in_flight.pop(digest, None)
+
+def folder_files(folder):
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if not f.startswith(".") and os.path.isfile(os.path.join(folder, f)))
+
+def folder_file_ids(folder):
+    manifest = upload_manifest()
+    digests = [(path, file_sha256(path)) for path in folder_files(folder)]
+    with _upload_lock:
+        if any(digest not in manifest["files"] for _, digest in digests):
+            # another process may have uploaded these since the manifest was loaded
+            save_upload_manifest()
+    pending = []
+    for path, digest in digests:
+        with _upload_lock:
+            entry = manifest["files"].get(digest)
+            if entry is not None:
+                pending.append(entry["file_id"])
+                continue
+            # another agent may already be uploading the same content
+            if digest not in _uploads_in_flight:
+                _uploads_in_flight[digest] = _upload_pool.submit(carry_context(upload_file), path, digest)
+            pending.append(_uploads_in_flight[digest])
+    with _upload_lock:
+        save_upload_manifest()
+    file_ids = [item if isinstance(item, str) else item.result() for item in pending]
+    return list(dict.fromkeys(file_ids))
+
+def prune_uploads(chart=None):
+    # drops uploads no file in any agent folder hashes to any more (edited or deleted documents) from the file store
+    manifest = upload_manifest()
+    folders = {spec["files_folder"] for spec in chart_specs(agency_chart if chart is None else chart).values() if spec.get("files_folder")}
+    paths = [path for folder in folders if os.path.isdir(folder) for path in folder_files(folder)]
+    live = {file_sha256(path) for path in paths}
+    with _upload_lock:
+        stale = {digest: entry for digest, entry in manifest["files"].items() if digest not in live}
+        _upload_dropped_paths.update(set(manifest["hashes"]) - set(paths))
+        manifest["hashes"] = {path: cached for path, cached in manifest["hashes"].items() if path in set(paths)}
+    for digest, entry in stale.items():
+        try:
+            get_openai_client().files.delete(entry["file_id"])
+            print(f"Removed outdated upload {entry['name']} ({entry['file_id']})")
+        except Exception as e:
+            print(f"Could not remove outdated upload {entry['file_id']}: {e}")
+        with _upload_lock:
+            manifest["files"].pop(digest, None)
+            _upload_removed.add(digest)
+    with _upload_lock:
+        save_upload_manifest()
+
+def build_agent(spec):
+    # the analysts upload the lead tables, so they're the only agents that wait on the dataset sync
+    if spec.get("files_folder") in {os.path.dirname(dataset["leads_path"]) for dataset in fema_datasets.values()}:
+        dataset_sync().result()
+    spec = dict(spec)
+    folder = spec.pop("files_folder", None)
+    file_ids = []
+    if folder and os.path.isdir(folder):
+        file_ids = folder_file_ids(folder)
+    elif folder:
+        print(f"Files folder '{folder}' for {spec['name']} doesn't exist, building it without files.")
+    with span("agent.build", agent=spec["name"], files=len(file_ids)):
+        return Agent(**spec, file_ids=file_ids)
+
+# agency builds write settings.json, so only one runs at a time
+_agency_build_lock = threading.Lock()
+
+def create_agency(chart=None):
+    init_openai()
+    chart = agency_chart if chart is None else chart
+    with _agency_build_lock, span("agency.build", agents=len(chart_specs(chart))):
+        return build_agency(chart)
+
+def chart_specs(chart):
+    specs = {}
+    for node in chart:
+        for spec in (node if isinstance(node, list) else [node]):
+            specs[spec["name"]] = spec
+    return specs
+
+def build_agency(chart):
+    specs = chart_specs(chart)
+    # agents build side by side; agents sharing a folder share its uploads through the manifest
+    with ThreadPoolExecutor(max_workers=len(specs)) as agent_pool:
+        agents = dict(zip(specs, agent_pool.map(carry_context(build_agent), specs.values())))
+
+    def resolve(node):
+        return [agents[spec["name"]] for spec in node] if isinstance(node, list) else agents[node["name"]]
+
+    agency = Agency([resolve(node) for node in chart], shared_instructions=agency_manifesto)
+    for agent in agents.values():
+        _agent_agencies[id(agent)] = agency
+    return agency
+
+def subchart(chart, root):
+    # the part of a chart reachable from root, with root as the ceo. parents are listed before their children
+    names = {root["name"]}
+    nodes = [root]
+    for node in chart:
+        if isinstance(node, list) and node[0]["name"] in names:
+            nodes.append(node)
+            names.update(spec["name"] for spec in node)
+    return nodes
+
+deal_chart = subchart(agency_chart, deal_calculator)
+
+# batch rfp triage
+# scores every rfp in the rfp_bank folder headlessly through the deal calculator hierarchy. every rfp gets a fresh agency
+# (so its own threads) on a bounded worker pool, results are appended to a checkpoint as they land so a rerun skips
+# whatever already finished, and the run ends with a ranked scorecard
+RFP_BANK_DIR = f"{SALESDOCS_DIR}/rfp_bank"
+TRIAGE_DIR = f"{SALESDOCS_DIR}/triage"
+TRIAGE_PROMPT = """Score the RFP '{rfp}' from your files. Work out its jurisdiction and run it through the EvaluateDeal tool; only if it reports
+missing scores, get those from the agents yourself and use the DealScore tool on the completed scores.
+Finish your reply with one line in exactly this form: FINAL SCORE: <percentage>% - <verdict>"""
+
+def rfp_name(file_name):
+    # strips the _file-<id> agency_swarm adds once a file has been uploaded
+    stem, ext = os.path.splitext(file_name)
+    return re.sub(r"_file-[A-Za-z0-9]+$", "", stem) + ext
+
+def list_rfps(rfp_dir=RFP_BANK_DIR):
+    return sorted({rfp_name(f) for f in os.listdir(rfp_dir) if not f.startswith(".") and os.path.isfile(os.path.join(rfp_dir, f))})
+
+def agency_threads(agency):
+    yield agency.main_thread
+    for threads in agency.agents_and_threads.values():
+        yield from threads.values()
+
+def agency_token_usage(agency):
+    client = get_openai_client()
+    total = 0
+    for thread in agency_threads(agency):
+        if not getattr(thread, "id", None):
+            continue
+        for run in client.beta.threads.runs.list(thread_id=thread.id):
+            usage = getattr(run, "usage", None)
+            total += usage.total_tokens if usage else 0
+    return total
+
+def triage_rfp(rfp):
+    with trace("triage.rfp", rfp=rfp_name(rfp)):
+        return score_rfp(rfp)
+
+def score_rfp(rfp):
+    started = time.perf_counter()
+    result = {"rfp": rfp, "percentage": None, "verdict": None, "seconds": None, "tokens": None, "error": None}
+    agency = None
+    try:
+        agency = create_agency(deal_chart)
+        reply = agency.get_completion(message=TRIAGE_PROMPT.format(rfp=rfp), yield_messages=False) or ""
+        match = re.search(r"FINAL SCORE:\s*([\d.]+)\s*%\s*[-–:]\s*(.+)", reply)
+        if match:
+            result["percentage"] = float(match.group(1))
+            result["verdict"] = match.group(2).strip()
+        else:
+            result["error"] = "no FINAL SCORE line in the reply"
+    except Exception as e:
+        result["error"] = str(e)
+    result["seconds"] = round(time.perf_counter() - started, 1)
+    if agency is not None:
+        try:
+            result["tokens"] = agency_token_usage(agency)
+            annotate(tokens=result["tokens"])
+        except Exception as e:
+            print(f"Could not read token usage for '{rfp}': {e}")
+    return result
+
+def read_triage_checkpoint(checkpoint_path):
+    done = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint:
+            for line in checkpoint:
+                if line.strip():
+                    result = json.loads(line)
+                    done[result["rfp"]] = result
+    return done
+
+def triage_rfp_bank(rfp_dir=RFP_BANK_DIR, out_dir=TRIAGE_DIR, workers=4):
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint_path = os.path.join(out_dir, "checkpoint.jsonl")
+    scorecard_path = os.path.join(out_dir, "scorecard.csv")
+    # only scored rfps count as done; failures get another go on the next run
+    done = {rfp: result for rfp, result in read_triage_checkpoint(checkpoint_path).items() if result["percentage"] is not None}
+    todo = [rfp for rfp in list_rfps(rfp_dir) if rfp not in done]
+    print(f"Triaging {len(todo)} RFPs ({len(done)} already scored) with {workers} workers.")
+    started = time.perf_counter()
+    checkpoint_lock = threading.Lock()
+
+    def run(rfp):
+        result = triage_rfp(rfp)
+        with checkpoint_lock, open(checkpoint_path, 'a') as checkpoint:
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        print(f"{rfp}: {result['percentage']}% {result['verdict'] or result['error']} ({result['seconds']}s, {result['tokens']} tokens)")
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as triage_pool:
+        results = list(triage_pool.map(run, todo))
+
+    scorecard = pd.DataFrame(list(done.values()) + results, columns=["rfp", "percentage", "verdict", "seconds", "tokens", "error"])
+    scorecard = scorecard.sort_values("percentage", ascending=False, na_position="last")
+    scorecard.to_csv(scorecard_path, index=False)
+    print(f"Triage finished in {time.perf_counter() - started:.1f}s. Scorecard saved to '{scorecard_path}'")
+    return scorecard
+
+# answer cache
+# repeat questions ("top CAYG leads in CA") are answered from sqlite instead of another round of assistant runs. the key
+# is the normalised prompt, the agent it went to and a fingerprint of the synced datasets and every files_folder, so a
+# data refresh or a changed document invalidates on its own. only the opening message of a conversation is looked up,
+# since anything later depends on the thread's history
+ANSWER_CACHE_PATH = f"{SALESDOCS_DIR}/.answer_cache.sqlite"
+ANSWER_CACHE_TTL = 24 * 60 * 60
+ANSWER_CACHE_MAX_ENTRIES = 1000
+
+def normalize_prompt(prompt):
+    return " ".join(re.sub(r"[^\w\s$%.-]", " ", prompt.lower()).split())
+
+def data_version():
+    # what the data is rather than when it was written, so a rewrite with the same content (a restart, a rebuilt lead
+    # table) keeps the cached answers: every shard's high-water mark and record count from its sidecar, and the content
+    # hash of every file in a files_folder (the same sha256 the upload manifest keeps)
+    fingerprint = hashlib.sha256()
+    for name, spec in sorted(fema_datasets.items()):
+        for shard in dataset_shards(spec):
+            state = fema_load_sync_state(shard["json_path"])
+            if state is not None:
+                fingerprint.update(f"{name}:{os.path.basename(shard['json_path'])}:{state.get('high_water')}:{state.get('records')}\n".encode())
+    folders = sorted({spec["files_folder"] for spec in chart_specs(agency_chart).values() if spec.get("files_folder")})
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        digests = []
+        for path in folder_files(folder):
+            try:
+                digests.append(file_sha256(path))
+            except OSError:
+                continue
+        fingerprint.update(f"{folder}:{','.join(sorted(digests))}\n".encode())
+    return fingerprint.hexdigest()
+
+def answer_cache_connect():
+    db = sqlite3.connect(ANSWER_CACHE_PATH, timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("""CREATE TABLE IF NOT EXISTS answers (
+        key TEXT PRIMARY KEY, agent TEXT, prompt TEXT, version TEXT, answer TEXT, created_at REAL, last_used REAL)""")
+    return db
+
+def answer_cache_key(agent_name, prompt, version):
+    return hashlib.sha256(f"{agent_name}\0{normalize_prompt(prompt)}\0{version}".encode()).hexdigest()
+
+def cached_answer(agent_name, prompt):
+    now = time.time()
+    key = answer_cache_key(agent_name, prompt, data_version())
+    with closing(answer_cache_connect()) as db:
+        row = db.execute("SELECT answer FROM answers WHERE key = ? AND created_at > ?", (key, now - ANSWER_CACHE_TTL)).fetchone()
+        if row:
+            db.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+            return row[0]
+    return None
+
+def cache_answer(agent_name, prompt, answer):
+    now = time.time()
+    version = data_version()
+    with closing(answer_cache_connect()) as db:
+        db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (answer_cache_key(agent_name, prompt, version), agent_name, normalize_prompt(prompt), version, answer, now, now))
+        # anything built on older data or past its ttl can never be hit again; past that, least recently used goes first
+        db.execute("DELETE FROM answers WHERE version != ? OR created_at <= ?", (version, now - ANSWER_CACHE_TTL))
+        db.execute("""DELETE FROM answers WHERE key NOT IN (
+            SELECT key FROM answers ORDER BY last_used DESC LIMIT ?)""", (ANSWER_CACHE_MAX_ENTRIES,))
+
+def remember_cached_answer(agency, prompt, answer):
+    # a cached answer never went through the main thread, so leave it there as context for the follow-up questions
+    thread = agency.main_thread
+    if not thread.thread:
+        thread.init_thread()
+    get_openai_client().beta.threads.messages.create(
+        thread_id=thread.id,
+        role="user",
+        content=f"For context, earlier in this conversation I asked: {prompt}\nAnd you answered: {answer}",
+    )
+
+# request tracing for the chat
+# agency_swarm runs a whole conversation (tool calls, SendMessage hops) synchronously inside get_completion, so the gaps
+# between the messages it yields are the hop and tool timings. setting the current span as the messages go by also
+# parents whatever the tools trace themselves (fema.get etc.) under the hop or tool call that caused it
+def thread_tokens(agency, sender, recipient):
+    if sender.lower() == "user":
+        thread = agency.main_thread
+    else:
+        thread = agency.agents_and_threads.get(sender, {}).get(recipient)
+    usage = getattr(getattr(thread, "run", None), "usage", None)
+    return usage.total_tokens if usage else None
+
+def trace_messages(agency, messages):
+    request_span = _current_span.get()
+    open_spans = []
+    try:
+        for message in messages:
+            now = time.time_ns()
+            top = open_spans[-1] if open_spans else None
+            if message.msg_type == "text":
+                if top and top[0] == "hop" and top[1] == (message.receiver_name, message.sender_name):
+                    # the reply closes the hop
+                    open_spans.pop()
+                    top[2]["attrs"]["tokens"] = thread_tokens(agency, message.receiver_name, message.sender_name)
+                    end_span(top[2], now)
+                else:
+                    hop = new_span(f"agent {message.sender_name} -> {message.receiver_name}", start_ns=now)
+                    open_spans.append(("hop", (message.sender_name, message.receiver_name), hop))
+            elif message.msg_type == "function":
+                tool_name = re.search(r"name='([^']+)'", str(message.content))
+                # SendMessage shows up as the hop it starts, and never yields a function_output to close it
+                if tool_name and not tool_name.group(1).startswith(("SendMessage", "GetResponse")):
+                    tool = new_span(f"tool {tool_name.group(1)}", start_ns=now, agent=message.sender_name)
+                    open_spans.append(("tool", tool_name.group(1), tool))
+            elif message.msg_type == "function_output":
+                if top and top[0] == "tool" and top[1] == message.sender_name:
+                    open_spans.pop()
+                    top[2]["attrs"]["bytes"] = len(str(message.content))
+                    end_span(top[2], now)
+            _current_span.set(open_spans[-1][2] if open_spans else request_span)
+            yield message
+    finally:
+        for _, _, unfinished in reversed(open_spans):
+            end_span(unfinished, error="unfinished")
+        _current_span.set(request_span)
+
+def traced_completion(agency, message):
+    # yields the agency's messages and then the finished trace (the root span dict, see trace()).
+    # the completion runs on a thread of its own: gradio can step a generator from different worker threads, which
+    # would scatter the context the spans hang off
+    results = queue.Queue()
+    done = object()
+
+    def pump():
+        try:
+            with trace("chat.request", prompt_chars=len(message)) as root:
+                for bot_message in trace_messages(agency, agency.get_completion(message=message)):
+                    results.put(bot_message)
+            results.put((done, root))
+        except Exception as e:
+            results.put((done, e))
+
+    threading.Thread(target=pump, name="chat-request", daemon=True).start()
+    while True:
+        item = results.get()
+        if isinstance(item, tuple) and item[0] is done:
+            if isinstance(item[1], Exception):
+                raise item[1]
+            yield item[1]
+            return
+        yield item
+
+# chat sessions
+# the UI serves many salespeople at once. each browser session holds its own agency (claim_agency) in gr.State, so
+# conversations never share threads and one long agent chain doesn't hold up anyone else's. the handlers are async and
+# everything that blocks (agency builds, assistant runs, sqlite) goes to a pool sized to SESSION_CONCURRENCY, the
+# number of requests gradio runs at once. not the loop's default executor: a session waiting between agent messages
+# holds its thread the whole time, and that one is only cpu count + 4 threads big
+SESSION_CONCURRENCY = int(os.getenv("SESSION_CONCURRENCY", "16"))
+_session_pool = ThreadPoolExecutor(max_workers=SESSION_CONCURRENCY, thread_name_prefix="session")
+
+async def off_loop(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_session_pool, carry_context(fn), *args)
+
+def launch_ui(height=600, dark_mode=True, server_name=None, server_port=None):
+    import gradio as gr
+
+    # same chat layout as Agency.demo_gradio, but up before the agency exists: a session's first message waits for its own
+    js = """function () {
+      gradioURL = window.location.href
+      if (!gradioURL.endsWith('?__theme={theme}')) {
+        window.location.replace(gradioURL + '?__theme={theme}');
+      }
+    }""".replace("{theme}", "dark" if dark_mode else "light")
+
+    with gr.Blocks(js=js) as demo:
+        chatbot = gr.Chatbot(height=height)
+        msg = gr.Textbox()
+        breakdown = gr.Markdown()
+        session = gr.State()
+
+        def user(user_message, history):
+            return "", history + [["👤 User: " + user_message.strip(), None]]
+
+        async def bot(history, session):
+            session = session if session is not None else {}
+            message = history[-1][0].removeprefix("👤 User: ")
+            coordinator = agency_coordinator["name"]
+            opening = sum(1 for user_message, _ in history if user_message) == 1
+            if opening:
+                answer = await off_loop(cached_answer, coordinator, message)
+                if answer is not None:
+                    history.append((None, f"🤖 {coordinator} (cached): {answer}"))
+                    # handed to the session's threads with the follow-up, if there is one
+                    session["context"] = (message, answer)
+                    yield history, "answered from the local cache", session
+                    return
+            if "agency" not in session:
+                session["agency"] = await off_loop(claim_agency)
+            if "context" in session:
+                await off_loop(remember_cached_answer, session["agency"], *session.pop("context"))
+            final_answer = None
+            completion = traced_completion(session["agency"], message)
+            while (bot_message := await off_loop(next, completion, None)) is not None:
+                if isinstance(bot_message, dict):
+                    yield history, trace_breakdown(bot_message), session
+                    continue
+                if bot_message.sender_name.lower() == "user":
+                    continue
+                if bot_message.msg_type == "text" and bot_message.receiver_name.lower() == "user":
+                    final_answer = bot_message.content
+                history.append((None, bot_message.get_sender_emoji() + " " + bot_message.get_formatted_content()))
+                yield history, gr.update(), session
+            if opening and final_answer:
+                await off_loop(cache_answer, coordinator, message, final_answer)
+
+        msg.submit(user, [msg, chatbot], [msg, chatbot], queue=False).then(
+            bot, [chatbot, session], [chatbot, breakdown, session], concurrency_limit=SESSION_CONCURRENCY)
+        demo.queue(default_concurrency_limit=SESSION_CONCURRENCY)
+
+    demo.launch(server_name=server_name, server_port=server_port)
+    return demo
+
+def main():
+    parser = argparse.ArgumentParser(description="Sales agency for openFEMA lead generation and RFP scoring.")
+    parser.add_argument("--triage", action="store_true", help="score every RFP in the rfp_bank folder headlessly instead of starting the UI")
+    parser.add_argument("--workers", type=int, default=4, help="RFPs scored at once in --triage mode")
+    parser.add_argument("--host", default=None, help="address the UI listens on, e.g. 0.0.0.0 to serve the whole team")
+    parser.add_argument("--port", type=int, default=None, help="port the UI listens on")
+    args = parser.parse_args()
+    check_keys()
+    if args.triage:
+        triage_rfp_bank(workers=args.workers)
+        return
+    # kick both off now so they overlap with gradio starting up
+    dataset_sync()
+    agency_startup()
+    launch_ui(height=600, server_name=args.host, server_port=args.port)
 
 #demo!
-agency.demo_gradio(height=600)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+import os
+import json
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+# sales1 reads its config at import, so everything it writes goes to a scratch dir and nothing is cached between requests
+os.environ["SALESDOCS_DIR"] = tempfile.mkdtemp(prefix="sales1_test_")
+os.environ["FEMA_HTTP_CACHE"] = "0"
+os.environ["FEMA_PAGE_SIZE"] = "50"
+import sales1
+from bench_fema import mock_server
+
+sales1.FEMA_BACKOFF_BASE = 0.001
+sales1.FEMA_MAX_RETRIES = 1
+
+# the bench's openFEMA stand-in, serving a list of rows: $top/$skip paging, $count, lastRefresh ge/gt filters, $orderby
+# on lastRefresh, ETags, and pages that can be made to fail
+def record(i, day=1):
+    return {"id": f"r{i}", "lastRefresh": f"2024-01-{day:02d}T00:00:00Z", "amount": i}
+
+@pytest.fixture
+def fema(tmp_path):
+    server = mock_server({"entities": ["Things"], "rows": [record(i, 1 + i // 50) for i in range(300)]})
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_port}/v1/Things?$select=id,lastRefresh,amount"
+    server.path = str(tmp_path / "things.json")
+    yield server
+    server.shutdown()
+
+def saved_ids(path):
+    return [row["id"] for row in sales1.fema_iter_saved(path)]
+
+# fetch resume
+def test_failed_snapshot_resumes_at_next_page(fema):
+    fema.config["fail_skips"].add(150)
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 150
+    state = sales1.fema_load_sync_state(fema.path)
+    assert state["complete"] is False
+    assert state["resume"]["next_skip"] == 150
+
+    fema.config["fail_skips"].clear()
+    fema.config["requests"].clear()
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 300
+    # the pages before the checkpoint aren't fetched again
+    pages = [params for params in fema.config["requests"] if "$count" not in params and "$inlinecount" not in params]
+    assert min(int(params["$skip"]) for params in pages) == 150
+    assert sorted(saved_ids(fema.path)) == sorted(f"r{i}" for i in range(300))
+    state = sales1.fema_load_sync_state(fema.path)
+    assert state["complete"] is True and state["resume"] is None
+    assert not os.path.exists(fema.path + ".partial")
+
+def test_resume_drops_writes_past_the_checkpoint(fema):
+    fema.config["fail_skips"].add(100)
+    sales1.fema_sync(fema.url, "Things", fema.path, max_records=None)
+    # a page that landed after the last checkpoint, e.g. just before a crash
+    with open(fema.path + ".partial", 'ab') as partial_file:
+        partial_file.write(b'{"id": "torn", "lastRef')
+
+    fema.config["fail_skips"].clear()
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 300
+    ids = saved_ids(fema.path)
+    assert "torn" not in ids
+    assert len(ids) == len(set(ids)) == 300
+
+def test_resume_drops_rows_shifted_into_the_resumed_pages(fema):
+    fema.config["fail_skips"].add(150)
+    sales1.fema_sync(fema.url, "Things", fema.path, max_records=None)
+    # refreshed upstream before the resume: they jump to the front of the newest-first order and push ten rows
+    # that were already pulled into the page the resume starts at
+    for i in range(10):
+        fema.config["rows"][i] = record(i, 30)
+
+    fema.config["fail_skips"].clear()
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 290
+    ids = saved_ids(fema.path)
+    assert len(ids) == len(set(ids)) == 290
+    # and the delta after it picks up the refreshed ones the snapshot missed
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 300
+    assert sorted(saved_ids(fema.path)) == sorted(f"r{i}" for i in range(300))
+
+# delta sync and capped copies
+def test_delta_merges_changed_and_new_records(fema):
+    sales1.fema_sync(fema.url, "Things", fema.path, max_records=None)
+    high_water = sales1.fema_load_sync_state(fema.path)["high_water"]
+
+    fema.config["rows"][0] = {**record(0, 20), "amount": -1}
+    fema.config["rows"].append(record(999, 21))
+    fema.config["requests"].clear()
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 301
+    assert f"lastRefresh gt '{high_water}'" in fema.config["requests"][0]["$filter"]
+    saved = {row["id"]: row for row in sales1.fema_iter_saved(fema.path)}
+    assert saved["r0"]["amount"] == -1
+    assert "r999" in saved
+    assert sales1.fema_load_sync_state(fema.path)["high_water"] == "2024-01-21T00:00:00Z"
+
+def test_interrupted_delta_keeps_the_last_complete_timestamp(fema):
+    sales1.fema_sync(fema.url, "Things", fema.path, max_records=None)
+    fema.config["rows"] += [record(1000 + i, 20 + i // 60) for i in range(120)]
+    fema.config["fail_skips"].add(100)
+    sales1.fema_sync(fema.url, "Things", fema.path, max_records=None)
+    # the 20th was consumed in full, the 21st only partly
+    assert sales1.fema_load_sync_state(fema.path)["high_water"] == "2024-01-20T00:00:00Z"
+
+    fema.config["fail_skips"].clear()
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=None) == 420
+    ids = saved_ids(fema.path)
+    assert len(ids) == len(set(ids))
+
+def test_capped_copy_is_the_newest_records_and_never_delta_synced(fema):
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=100) == 100
+    assert sorted(saved_ids(fema.path)) == sorted(f"r{i}" for i in range(200, 300))
+    assert sales1.fema_load_sync_state(fema.path)["truncated"] is True
+
+    fema.config["requests"].clear()
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=100) == 100
+    assert not any("lastRefresh" in params.get("$filter", "") for params in fema.config["requests"])
+
+def test_unchanged_capped_copy_is_left_alone(fema):
+    sales1.fema_sync(fema.url, "Things", fema.path, max_records=100)
+    mtime = os.stat(fema.path).st_mtime_ns
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=100) == 100
+    assert os.stat(fema.path).st_mtime_ns == mtime
+
+    # a newly refreshed record pushes the oldest one out of the cap
+    fema.config["rows"].append(record(999, 30))
+    assert sales1.fema_sync(fema.url, "Things", fema.path, max_records=100) == 100
+    assert "r999" in saved_ids(fema.path) and "r200" not in saved_ids(fema.path)
+    assert os.stat(fema.path).st_mtime_ns != mtime
+
+# http cache
+@pytest.fixture
+def http_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(sales1, "FEMA_HTTP_CACHE", True)
+    monkeypatch.setattr(sales1, "FEMA_HTTP_CACHE_DIR", str(tmp_path / "http_cache"))
+
+def cached_get(url):
+    attrs = {}
+    response = sales1.fema_get_cached(url, attrs)
+    return attrs["cache"], json.loads(response.content)["Things"]
+
+def test_http_cache_serves_fresh_entries_and_revalidates_stale_ones(fema, http_cache, monkeypatch):
+    url = fema.url + "&$top=10&$skip=0"
+    assert cached_get(url)[0] == "miss"
+    # the same query with its params in another order is the same entry
+    assert cached_get(fema.url.replace("?$select=id,lastRefresh,amount", "?$skip=0&$top=10&$select=id,lastRefresh,amount")) == cached_get(url)
+    assert cached_get(url)[0] == "hit"
+    assert len(fema.config["requests"]) == 1
+
+    monkeypatch.setattr(sales1, "FEMA_HTTP_CACHE_TTL", 0)
+    assert cached_get(url) == ("revalidated", [record(i, 1) for i in range(10)])
+    fema.config["rows"][0] = {**record(0, 1), "amount": -1}
+    cache, rows = cached_get(url)
+    assert cache == "miss" and rows[0]["amount"] == -1
+    assert len(fema.config["requests"]) == 3
+
+def test_http_cache_evicts_least_recently_used_first(fema, http_cache):
+    urls = [fema.url + f"&$top=10&$skip={skip}" for skip in (0, 10, 20)]
+    for age, url in enumerate(urls):
+        cached_get(url)
+        os.utime(sales1.http_cache_paths(url)[0], (age, age))
+    sales1.http_cache_touch(urls[0])
+    sizes = [os.path.getsize(sales1.http_cache_paths(url)[0]) for url in urls]
+    sales1.http_cache_evict(max_bytes=sizes[0] + sizes[2])
+    assert [sales1.http_cache_read(url)[0] is not None for url in urls] == [True, False, True]
+
+# synced datasets: a couple of records per dataset written straight to their shards (and sidecars), for the code that
+# reads them back
+@pytest.fixture
+def datasets(tmp_path, monkeypatch):
+    specs = {name: {**spec, "states": ["OK"], "data_dir": str(tmp_path / name), "leads_path": str(tmp_path / name / f"{name}_leads.json")}
+             for name, spec in sales1.fema_datasets.items()}
+    monkeypatch.setattr(sales1, "fema_datasets", specs)
+    monkeypatch.setattr(sales1, "FEMA_DB_PATH", str(tmp_path / "fema.sqlite"))
+    synced = Future()
+    synced.set_result({})
+    monkeypatch.setattr(sales1, "dataset_sync", lambda: synced)
+
+    def write(name, records):
+        json_path = sales1.dataset_shards(specs[name])[0]["json_path"]
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+        fema_records = [{"id": f"{name}-{i}", "lastRefresh": "2024-01-01T00:00:00Z", **record} for i, record in enumerate(records)]
+        sales1.fema_save_stream(fema_records, json_path)
+        sales1.fema_save_sync_state(json_path, {"high_water": "2024-01-01T00:00:00Z", "records": len(fema_records), "complete": True, "resume": None})
+    write("cayg", [
+        {"declarationType": "DR", "stateCode": "OK", "disasterNumber": 4000, "incidentType": "Flood", "applicantName": "City of Tulsa", "federalShareObligated": 100.0},
+        {"declarationType": "DR", "stateCode": "OK", "disasterNumber": 4001, "incidentType": "Fire", "applicantName": "City of Norman", "federalShareObligated": 40.0},
+    ])
+    write("hma", [
+        {"programArea": "HMGP", "programFy": 2021, "state": "Oklahoma", "disasterNumber": 4000, "recipient": "TULSA, CITY OF", "federalShareObligated": 50.0},
+        {"programArea": "BRIC", "programFy": 2022, "state": "Oklahoma", "disasterNumber": 4000, "recipient": "TULSA, CITY OF", "federalShareObligated": 75.5},
+        {"programArea": "FMA", "programFy": 2022, "state": "Oklahoma", "disasterNumber": 4001, "recipient": "TULSA, CITY OF", "federalShareObligated": 10.0},
+    ])
+    return write
+
+# columnar reads
+def hma_years(filters):
+    return sorted(sales1.read_dataset("hma", columns=["programFy"], filters=filters)["programFy"].tolist())
+
+def test_json_fallback_applies_every_filter_op(datasets):
+    assert hma_years([("programFy", ">=", 2022)]) == [2022, 2022]
+    assert hma_years([("programFy", "<", 2022)]) == [2021]
+    assert hma_years([("programFy", "!=", 2021), ("recipient", "==", "TULSA, CITY OF")]) == [2022, 2022]
+    assert hma_years([("programArea", "not in", ["HMGP", "FMA"])]) == [2022]
+    with pytest.raises(ValueError):
+        hma_years([("programFy", "~", 2021)])
+
+def test_stale_parquet_copy_is_not_read(datasets):
+    shard = sales1.dataset_shards(sales1.fema_datasets["hma"])[0]
+    sales1.save_columnar(sales1.fema_datasets["hma"], shard)
+    assert hma_years([("programFy", ">=", 2022)]) == [2022, 2022]
+    # a sync that landed after the last conversion, as when the conversion failed
+    os.utime(shard["parquet_path"], (1, 1))
+    datasets("hma", [{"programFy": year, "state": "Oklahoma", "recipient": "TULSA, CITY OF", "federalShareObligated": 1.0} for year in (2021, 2023)])
+    assert hma_years([("programFy", ">=", 2022)]) == [2023]
+
+# query index
+def fema_query(**kwargs):
+    reply = sales1.FemaQuery(**kwargs).run()
+    return json.loads(reply) if reply.startswith("[") else reply
+
+def test_fema_query_before_the_index_is_built(datasets):
+    assert fema_query(dataset="hma") == "The hma dataset hasn't been indexed yet."
+    assert not os.path.exists(sales1.FEMA_DB_PATH)
+    sales1.save_query_index("hma")
+    assert fema_query(dataset="cayg") == "The cayg dataset hasn't been indexed yet."
+
+def test_fema_query_takes_state_codes_or_names_and_literal_wildcards(datasets):
+    datasets("hma", [
+        {"programFy": 2021, "state": "Oklahoma", "recipient": "TULSA, CITY OF", "federalShareObligated": 50.0},
+        {"programFy": 2022, "state": "Oklahoma", "recipient": "OK_100% FUND", "federalShareObligated": 10.0},
+    ])
+    sales1.save_query_index("hma")
+    for state in ("OK", "oklahoma"):
+        assert [row["recipient"] for row in fema_query(dataset="hma", state=state)] == ["TULSA, CITY OF", "OK_100% FUND"]
+    assert fema_query(dataset="hma", state="Atlantis") == "Unknown state 'Atlantis'."
+    assert [row["recipient"] for row in fema_query(dataset="hma", name_contains="0% f")] == ["OK_100% FUND"]
+    assert fema_query(dataset="hma", name_contains="T_LSA") == "No matching records."
+
+# typed columns
+def test_record_columns_keep_nulls_and_categories():
+    spec = sales1.fema_datasets["hma"]
+    frame = sales1.typed_frame(spec, [
+        {"id": "a", "programArea": "HMGP", "programFy": 2021, "state": "Oklahoma", "federalShareObligated": 10.5},
+        {"id": "b", "programArea": None, "programFy": "2022", "state": "Oklahoma", "federalShareObligated": "2.5"},
+        {"id": None, "programArea": "BRIC", "programFy": None, "federalShareObligated": None},
+        {"id": "d", "programArea": "HMGP", "programFy": "n/a", "state": "Texas", "federalShareObligated": "n/a"},
+    ])
+    assert list(frame.columns) == spec["select"]
+    assert str(frame["programArea"].dtype) == "category" and list(frame["programArea"].cat.categories) == ["HMGP", "BRIC"]
+    assert frame["programArea"].isna().tolist() == [False, True, False, False]
+    assert frame["state"].isna().tolist() == [False, False, True, False]
+    assert str(frame["programFy"].dtype) == "Int64"
+    assert frame["programFy"].tolist()[:2] == [2021, 2022] and frame["programFy"].isna().tolist() == [False, False, True, True]
+    assert frame["federalShareObligated"].dtype == "float64"
+    assert frame["federalShareObligated"].tolist()[:2] == [10.5, 2.5] and frame["federalShareObligated"].isna().tolist() == [False, False, True, True]
+    # fields the registry gives no type stay plain strings, missing ones null
+    assert frame["id"].tolist()[:2] == ["a", "b"] and frame["id"].isna().tolist() == [False, False, True, False]
+    assert frame["recipient"].isna().all()
+
+def test_record_columns_empty_frame_keeps_its_types():
+    frame = sales1.typed_frame(sales1.fema_datasets["hma"], [])
+    assert frame.empty and list(frame.columns) == sales1.fema_datasets["hma"]["select"]
+    assert str(frame["programArea"].dtype) == "category" and str(frame["programFy"].dtype) == "Int64" and frame["federalShareObligated"].dtype == "float64"
+
+# lead profiles
+def test_profiles_join_programs_and_key_the_trend_by_year(datasets):
+    sales1.save_lead_profiles()
+    [tulsa] = json.loads(sales1.LeadProfile(name="tulsa city of", state="Oklahoma").run())
+    assert tulsa["programs"] == 2
+    assert tulsa["caygTotal"] == 100.0 and tulsa["hmaTotal"] == 135.5
+    assert tulsa["trend"] == {"2021": 50.0, "2022": 85.5}
+    assert tulsa["aliases"] == {"cayg": ["City of Tulsa"], "hma": ["TULSA, CITY OF"]}
+
+    # cayg has no trend_field, so a lead only it knows has no trend
+    [norman] = json.loads(sales1.LeadProfile(name="City of Norman").run())
+    assert norman["trend"] == {}
+
+# answer cache
+def test_cached_answers_survive_rewrites_but_not_new_data(datasets, tmp_path, monkeypatch):
+    monkeypatch.setattr(sales1, "ANSWER_CACHE_PATH", str(tmp_path / "answers.sqlite"))
+    folder = os.path.join(sales1.SALESDOCS_DIR, "strategy")
+    os.makedirs(folder, exist_ok=True)
+    document = os.path.join(folder, "playbook.txt")
+    with open(document, 'w') as document_file:
+        document_file.write("v1")
+    try:
+        sales1.cache_answer("Coordinator", "Top leads in OK?", "Tulsa")
+        # the same data written out again, as a restart or a rebuilt lead table does
+        shard = sales1.dataset_shards(sales1.fema_datasets["cayg"])[0]["json_path"]
+        os.utime(shard, (1, 1))
+        with open(document, 'w') as document_file:
+            document_file.write("v1")
+        assert sales1.cached_answer("Coordinator", "top leads in ok") == "Tulsa"
+
+        with open(document, 'w') as document_file:
+            document_file.write("v2")
+        assert sales1.cached_answer("Coordinator", "top leads in ok") is None
+        sales1.cache_answer("Coordinator", "Top leads in OK?", "Tulsa")
+        assert sales1.cached_answer("Coordinator", "top leads in ok") == "Tulsa"
+
+        # a sync that merged newer records
+        state = sales1.fema_load_sync_state(shard)
+        sales1.fema_save_sync_state(shard, {**state, "high_water": "2024-02-01T00:00:00Z"})
+        assert sales1.cached_answer("Coordinator", "top leads in ok") is None
+    finally:
+        os.remove(document)
+
+# deal scoring
+def test_score_deal_weights_and_verdicts():
+    assert sales1.score_deal([5, 5, 5, 5, 5], "local") == {"percentage": 100.0, "verdict": "send it"}
+    assert sales1.score_deal([0, 0, 0, 0, 0], "state")["percentage"] == 0.0
+    # local: .12*4 + .15*3 + .38*4 + .12*2 + .23*3 = 3.38 of 5
+    assert sales1.score_deal([4, 3, 4, 2, 3], "local") == {"percentage": 67.6, "verdict": "probably shouldn't bid unless there is a good reason"}
+    assert sales1.score_deal([4, 4, 4, 3, 3], "federal")["verdict"] == "proceed with caution"
+
+@pytest.mark.parametrize("scores", [[5, 5, 5, 5], [5, 5, 5, 5, 6], [5, 5, 5, 5, -1]])
+def test_score_deal_rejects_bad_scores(scores):
+    with pytest.raises(ValueError):
+        sales1.score_deal(scores, "local")
+
+# deal evaluation replies
+def test_reply_score_reads_the_last_whole_score():
+    assert sales1.reply_score("SCORE: 2\nthen **SCORE:** 4") == 4
+    assert sales1.reply_score("SCORE: 4.5") is None
+    assert sales1.reply_score("no score here") is None
+
+# pipeline store
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    monkeypatch.setattr(sales1, "PIPELINE_DB_PATH", str(tmp_path / "pipeline.sqlite"))
+
+def test_upsert_merges_by_lead_key_and_keeps_unset_fields(pipeline):
+    first = sales1.upsert_opportunity("City of Tulsa", "OK", "CAYG", value=250000, owner="sam", notes="met at conference")
+    assert first["stage"] == "identified"
+    second = sales1.upsert_opportunity("TULSA, CITY OF", "OK", "CAYG", stage="qualified", notes="demo booked")
+    assert second["id"] == first["id"]
+    assert second["stage"] == "qualified"
+    assert second["value"] == 250000 and second["owner"] == "sam"
+    assert second["notes"] == "met at conference\ndemo booked"
+    # another product or state is another opportunity
+    assert sales1.upsert_opportunity("City of Tulsa", "OK", "HMA")["id"] != first["id"]
+
+def test_concurrent_upserts_land_in_one_row(pipeline):
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda i: sales1.upsert_opportunity("County of Kern", "CA", "HMA", notes=f"note {i}"), range(40)))
+    rows = sales1.query_pipeline("kern county")
+    assert len(rows) == 1
+    assert sorted(rows[0]["notes"].split("\n")) == sorted(f"note {i}" for i in range(40))
+
+def test_query_pipeline_matches_whole_lead_names(pipeline):
+    for i in range(100):
+        sales1.upsert_opportunity(f"Lead {i}", "CA", "CAYG")
+    assert [row["lead"] for row in sales1.query_pipeline("Lead 1")] == ["Lead 1"]
+    assert sales1.query_pipeline("Lead 1", state="TX") == []
+
+def test_export_appends_only_changes(pipeline, tmp_path):
+    export_path = str(tmp_path / "exports" / "pipeline.jsonl")
+    sales1.upsert_opportunity("Lead A", "CA", "CAYG")
+    sales1.upsert_opportunity("Lead B", "CA", "CAYG")
+    assert sales1.export_pipeline(export_path) == 2
+    assert sales1.export_pipeline(export_path) == 0
+    sales1.upsert_opportunity("Lead A", "CA", "CAYG", stage="won")
+    assert sales1.export_pipeline(export_path) == 1
+    with open(export_path) as export_file:
+        lines = [json.loads(line) for line in export_file]
+    latest = {row["id"]: row for row in lines}
+    assert len(lines) == 3 and len(latest) == 2
+    assert [row["stage"] for row in latest.values() if row["lead"] == "Lead A"] == ["won"]